@@ -10,7 +10,7 @@ import cv2
 import json
 import numpy as np
 
-from ballot_vision import load_keywords_from_file
+from errors import ImageDecodeError
 from find_keywords import calculate_affine_matrix
 
 # Путь к файлу с координатами прямоугольников
@@ -77,7 +77,7 @@ def transform_points(points, affine_matrix):
 
 
 #def analyze_rectangles(image_path, rectangles, affine_matrix):
-def analyze_rectangles(image_path, rectangles, affine_matrix=None, verbose_mode=False):
+def analyze_rectangles(image_path, rectangles, affine_matrix=None, verbose_mode=False, debug_info=None, deadline=None):
     """
     Функция analyze_rectangles предназначена для обнаружения и классификации контуров
     внутри заданных прямоугольных областей на изображении. Она выполняет следующие действия:
@@ -86,6 +86,11 @@ def analyze_rectangles(image_path, rectangles, affine_matrix=None, verbose_mode=
     3. Находит и фильтрует контуры по длине и форме, исключая нерелевантные.
     4. Классифицирует контуры на основе их геометрических характеристик.
     5. Выводит информацию о найденных и классифицированных контурах.
+
+    В качестве image_path можно передать путь к файлу или декодированное изображение (numpy массив).
+    Если передан список debug_info, в него добавляются координаты каждой вырезанной области и найденные контуры
+    (для сохранения через debug_artifacts.DebugArtifactWriter). Функция не открывает окон и не ждёт ввода.
+    Если передан deadline (deadline.Deadline) и время истекло, оставшиеся отметки получают значение None.
     """
 
     if affine_matrix is None:
@@ -93,10 +98,15 @@ def analyze_rectangles(image_path, rectangles, affine_matrix=None, verbose_mode=
         affine_matrix = np.eye(2, 3, dtype=np.float32)
 
 
-    img = cv2.imread(image_path)
+    # Можно передать как путь к файлу, так и уже декодированное (например, предобработанное) изображение
+    if isinstance(image_path, np.ndarray):
+        img = image_path
+    else:
+        img = cv2.imread(image_path)
     if img is None:
-        print(f"Error loading image '{image_path}'. Check the file path.")
-        exit(1)
+        raise ImageDecodeError(f"Error loading image '{image_path}'. Check the file path.")
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
 
     # Словарь для хранения результатов анализа
     marks_result = {}
@@ -104,6 +114,11 @@ def analyze_rectangles(image_path, rectangles, affine_matrix=None, verbose_mode=
 
 
     for i, rectangle in enumerate(rectangles, start=1):
+        if deadline is not None and deadline.expired():
+            # Время на бюллетень исчерпано — отметка не определена
+            marks_result[f"mark_{i}"] = None
+            continue
+
         # Применяем аффинное преобразование к координатам каждого прямоугольника
         transformed_points = transform_points([(rectangle[0], rectangle[1]), (rectangle[2], rectangle[3])], affine_matrix)
         x1, y1 = transformed_points[0]
@@ -134,10 +149,6 @@ def analyze_rectangles(image_path, rectangles, affine_matrix=None, verbose_mode=
             print(f"\nAnalyzing Rectangle {i}, found {len(contours)} contours.")
         #print(contours)
 
-        if verbose_mode:
-            # Рисуем все контуры на вырезанном изображении
-            cv2.drawContours(crop_img, contours, -1, (0, 0, 255), 2)
-
         # Анализ наличия отметок
         mark_present = False
 
@@ -162,13 +173,22 @@ def analyze_rectangles(image_path, rectangles, affine_matrix=None, verbose_mode=
 
         # Создаем список индексов контуров, которые нужно удалить
         contours_to_remove = []
+        undetermined = False
 
         for k, contour1 in enumerate(valid_contours):
+            # Попарное сравнение контуров может быть долгим, поэтому проверяем остаток времени и здесь
+            if deadline is not None and deadline.expired():
+                undetermined = True
+                break
             for j, contour2 in enumerate(valid_contours):
                 if k != j and j not in contours_to_remove and k not in contours_to_remove:
                     if is_contour_close(contour2, contour1, max_distance=10):
                         contours_to_remove.append(j)
 
+        if undetermined:
+            marks_result[f"mark_{i}"] = None
+            continue
+
         #print(contours_to_remove)
         # Удаляем контуры, индексы которых находятся в списке contours_to_remove
         filtered_contours = [cnt for k, cnt in enumerate(filtered_contours) if k not in contours_to_remove]
@@ -216,16 +236,22 @@ def analyze_rectangles(image_path, rectangles, affine_matrix=None, verbose_mode=
 
         marks_result[f"mark_{i}"] = mark_present
 
-        if verbose_mode:
-            # Выводим изображение с контурами
-            cv2.imshow(f"Rectangle {i} with Contours", crop_img)
-            cv2.waitKey(0)
-            cv2.destroyAllWindows()
+        if debug_info is not None:
+            # Сохраняем данные для отладочных артефактов; рисование выполняется позже в фоновом потоке
+            debug_info.append({
+                "index": i,
+                "box": (int(x1), int(y1), int(x2), int(y2)),
+                "contours": [cnt.reshape(-1, 2).tolist() for cnt in contours],
+                "filtered_contours": [cnt.reshape(-1, 2).tolist() for cnt in filtered_contours],
+                "mark": mark_present,
+            })
 
     return marks_result
 
 
 if __name__ == '__main__':
+    from ballot_vision import load_keywords_from_file
+
     json_file_path = 'rectangles.json'  # Укажите путь к вашему JSON файлу
     image_path = 'new_ballot.jpg'  # Укажите путь к вашему изображению
     rectangles = read_rectangles(json_file_path)
@@ -246,7 +272,7 @@ if __name__ == '__main__':
     new_json_file = 'new_ballot.json'
     #save_to_json(new_json_data, new_json_file)
 
-    M = calculate_affine_matrix(ref_json_file, new_json_file, keywords)
+    M, error = calculate_affine_matrix(ref_json_file, new_json_file, keywords)
 
 
     marks = analyze_rectangles(image_path, rectangles, M)
@@ -9,6 +9,7 @@
 
 import json
 
+from errors import AlignmentError
 from find_keywords import extract_words_with_coordinates, calculate_affine_matrix
 from pdf_vision import analyze_image
 
@@ -60,12 +61,13 @@ def main():
     new_json_file = 'templates/temp2_ref_ballot.json'
     save_to_json(new_json_data, new_json_file)
 
-    M = calculate_affine_matrix(ref_json_file, new_json_file, keywords)
-    if M is not None:
+    try:
+        M, error = calculate_affine_matrix(ref_json_file, new_json_file, keywords)
+    except AlignmentError as e:
+        print(f"Не удалось вычислить аффинную матрицу: {e}")
+    else:
         print("Матрица аффинного преобразования:")
         print(M)
-    else:
-        print("Не удалось вычислить аффинную матрицу.")
 
     #keywords_coords = extract_words_with_coordinates(json_data, keywords)
 
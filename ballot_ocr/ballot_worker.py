@@ -0,0 +1,190 @@
+"""
+Этот скрипт запускает распределённое распознавание бюллетеней: несколько узлов-обработчиков забирают задания
+из общей очереди (см. `work_queue`) и записывают в неё результаты `recognize_ballot`.
+
+Пока обработчик распознаёт бюллетень, фоновый поток продлевает аренду задания. Если обработчик упал,
+аренда истекает и задание забирает другой обработчик; результат при этом записывается идемпотентно.
+
+Использование (очередь — файл SQLite или директория на общей файловой системе):
+
+1. Добавить задания:  python ballot_worker.py enqueue --queue /shared/queue test_ballots/*.jpg
+2. Запустить обработчики на каждом узле:  python ballot_worker.py worker --queue /shared/queue --processes 4
+3. Получить результаты:  python ballot_worker.py results --queue /shared/queue
+
+Пути к изображениям в заданиях должны быть доступны всем узлам (общая файловая система).
+Для проверки на одной машине достаточно указать локальный файл, например --queue queue.sqlite.
+"""
+
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from json_utils import json_default
+from work_queue import open_queue
+
+
+def make_job_id(image_path):
+    """
+    Формирует идентификатор задания по содержимому изображения,
+    поэтому повторная постановка того же снимка в очередь не создаёт новое задание.
+    """
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def enqueue_images(queue, image_paths, options=None):
+    """
+    Ставит изображения в очередь.
+
+    :param queue: Очередь заданий.
+    :param image_paths: Пути к изображениям (доступные всем узлам).
+    :param options: Дополнительные параметры для recognize_ballot.
+    :return: Количество добавленных заданий.
+    """
+    added = 0
+    for image_path in image_paths:
+        payload = {"image_path": os.path.abspath(image_path), "options": options or {}}
+        if queue.enqueue(make_job_id(image_path), payload):
+            added += 1
+    return added
+
+
+def recognize_job(payload):
+    """Обработчик задания по умолчанию: распознаёт бюллетень из payload['image_path']."""
+    from recognize_ballot import recognize_ballot
+
+    # recognize_ballot сохраняет результат OCR в эту директорию
+    os.makedirs("ballots_jsons", exist_ok=True)
+    return recognize_ballot(payload["image_path"], **payload.get("options", {}))
+
+
+class LeaseKeeper:
+    """Фоновый поток, продлевающий аренду задания, пока оно обрабатывается."""
+
+    def __init__(self, queue, job_id, worker_id, lease_seconds):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        # Продлеваем аренду заранее, чтобы задержка одного сердцебиения не приводила к перехвату
+        while not self._stop.wait(self.lease_seconds / 3):
+            if not self.queue.heartbeat(self.job_id, self.worker_id, self.lease_seconds):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}".replace("~", "-")
+
+
+def run_worker(queue, worker_id=None, handler=recognize_job, lease_seconds=60, idle_sleep=1.0,
+               max_jobs=None, exit_when_empty=False, stop_event=None):
+    """
+    Основной цикл обработчика: берёт задание, обрабатывает его под продлеваемой арендой и записывает результат.
+
+    :param queue: Очередь заданий (SQLiteWorkQueue или DirectoryWorkQueue).
+    :param worker_id: Идентификатор обработчика; по умолчанию <hostname>-<pid>.
+    :param handler: Функция, принимающая payload задания и возвращающая результат, сериализуемый в JSON.
+    :param lease_seconds: Срок аренды задания.
+    :param idle_sleep: Пауза между опросами пустой очереди.
+    :param max_jobs: Остановиться после обработки указанного количества заданий.
+    :param exit_when_empty: Остановиться, когда в очереди не осталось заданий.
+    :param stop_event: threading.Event для остановки цикла извне.
+    :return: Количество обработанных заданий.
+    """
+    worker_id = worker_id or default_worker_id()
+    processed = 0
+
+    while not (stop_event and stop_event.is_set()):
+        if max_jobs is not None and processed >= max_jobs:
+            break
+
+        job = queue.lease(worker_id, lease_seconds)
+        if job is None:
+            if exit_when_empty:
+                break
+            time.sleep(idle_sleep)
+            continue
+
+        print(f"[{worker_id}] job {job.job_id[:12]} attempt {job.attempt}: {job.payload.get('image_path')}")
+        try:
+            with LeaseKeeper(queue, job.job_id, worker_id, lease_seconds) as keeper:
+                result = handler(job.payload)
+        except Exception as e:
+            print(f"[{worker_id}] job {job.job_id[:12]} failed: {e!r}")
+            queue.fail(job.job_id, worker_id, repr(e))
+        else:
+            if keeper.lost:
+                print(f"[{worker_id}] job {job.job_id[:12]}: lease was lost, result is written only if it is the first")
+            queue.complete(job.job_id, worker_id, result)
+        processed += 1
+
+    return processed
+
+
+def _worker_process(location, lease_seconds, exit_when_empty):
+    queue = open_queue(location)
+    run_worker(queue, lease_seconds=lease_seconds, exit_when_empty=exit_when_empty)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed ballot recognition over a shared work queue")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="add ballot images to the queue")
+    enqueue_parser.add_argument("--queue", required=True, help="SQLite file (*.sqlite, *.db) or shared directory")
+    enqueue_parser.add_argument("images", nargs="+")
+
+    worker_parser = subparsers.add_parser("worker", help="process jobs from the queue")
+    worker_parser.add_argument("--queue", required=True)
+    worker_parser.add_argument("--processes", type=int, default=1)
+    worker_parser.add_argument("--lease-seconds", type=float, default=60)
+    worker_parser.add_argument("--exit-when-empty", action="store_true")
+
+    results_parser = subparsers.add_parser("results", help="print collected results")
+    results_parser.add_argument("--queue", required=True)
+
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        added = enqueue_images(open_queue(args.queue), args.images)
+        print(f"Added {added} of {len(args.images)} images")
+    elif args.command == "worker":
+        processes = [multiprocessing.Process(target=_worker_process,
+                                             args=(args.queue, args.lease_seconds, args.exit_when_empty))
+                     for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    elif args.command == "results":
+        queue = open_queue(args.queue)
+        print(json.dumps({"stats": queue.stats(), "results": queue.results()},
+                         ensure_ascii=False, indent=4, default=json_default))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Этот скрипт реализует бюджет времени на обработку одного бюллетеня.
+
+Объект `Deadline` создаётся один раз при поступлении бюллетеня и передаётся через все этапы:
+вызов OCR (как таймаут запроса), перебор шаблонов и анализ контуров. Каждый этап проверяет остаток времени
+и при его исчерпании возвращает частичный результат с кодом статуса вместо того, чтобы занимать обработчик дальше:
+
+- `ok`: бюллетень обработан полностью;
+- `best_template_so_far`: перебраны не все шаблоны, использован лучший из проверенных;
+- `marks_undetermined`: часть отметок не проанализирована (их значение None).
+
+Ограничения могут сочетаться: если перебор шаблонов прервался и отметки тоже не успели проанализировать,
+в поле `status` результата остаётся первое из них (best_template_so_far), а поле `degradations` перечисляет все.
+
+Если время кончилось ещё до получения результата OCR или до первого подошедшего шаблона,
+выбрасывается errors.DeadlineExceeded.
+"""
+
+
+import time
+
+from errors import DeadlineExceeded
+
+STATUS_OK = "ok"
+STATUS_BEST_TEMPLATE_SO_FAR = "best_template_so_far"
+STATUS_MARKS_UNDETERMINED = "marks_undetermined"
+
+
+class Deadline:
+    """Момент, к которому обработка бюллетеня должна завершиться."""
+
+    def __init__(self, budget_seconds, clock=time.monotonic):
+        """
+        :param budget_seconds: Бюджет времени в секундах, отсчитывается от момента создания.
+        :param clock: Источник монотонного времени.
+        """
+        self.clock = clock
+        self.budget_seconds = budget_seconds
+        self.expires_at = clock() + budget_seconds
+
+    def remaining(self):
+        """Оставшееся время в секундах (не меньше нуля)."""
+        return max(0.0, self.expires_at - self.clock())
+
+    def expired(self):
+        return self.clock() >= self.expires_at
+
+    def check(self, stage):
+        """
+        Выбрасывает DeadlineExceeded, если время истекло.
+
+        :param stage: Название этапа для сообщения об ошибке.
+        """
+        if self.expired():
+            raise DeadlineExceeded(stage)
@@ -0,0 +1,221 @@
+"""
+Этот скрипт реализует неблокирующий режим отладочных артефактов для распознавания бюллетеней.
+Вместо показа каждого прямоугольника через cv2.imshow (что останавливает обработку до нажатия клавиши)
+фоновый поток сохраняет на диск:
+
+- вырезанные области отметок с нарисованными контурами (все найденные — красным, оставшиеся после фильтрации — зелёным);
+- данные контуров в JSON;
+- наложения для каждого шаблона: прямоугольники шаблона, перенесённые на изображение его аффинной матрицей, и ошибка подгонки.
+
+Сохраняются только выборочные бюллетени (недействительные, с плохой подгонкой шаблона или случайные с заданной вероятностью).
+Очередь на запись ограничена: если фоновый поток не успевает, новые артефакты отбрасываются, а не тормозят распознавание.
+Общий объём записанных файлов ограничен бюджетом на диске.
+"""
+
+
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+
+import cv2
+import numpy as np
+
+from json_utils import json_default
+
+
+class DebugArtifactWriter:
+    """
+    Фоновый писатель отладочных артефактов с выборкой, ограниченной очередью и бюджетом на диске.
+
+    Использование:
+        writer = DebugArtifactWriter("debug_artifacts")
+        recognize_ballot(image_path, debug_writer=writer)
+        ...
+        writer.close()
+    """
+
+    def __init__(self, output_dir="debug_artifacts", max_queue=16, disk_budget_bytes=200 * 1024 * 1024,
+                 sample_rate=0.0, max_affinity_error=5.0, min_inlier_ratio=0.5, overlay_max_side=1600):
+        """
+        :param output_dir: Директория для артефактов.
+        :param max_queue: Максимальное количество бюллетеней, ожидающих записи.
+        :param disk_budget_bytes: Максимальный общий объём артефактов в output_dir.
+        :param sample_rate: Доля остальных (действительных, хорошо подогнанных) бюллетеней, которые тоже сохраняются.
+        :param max_affinity_error: Бюллетени с ошибкой подгонки шаблона больше этого значения сохраняются всегда.
+        :param min_inlier_ratio: Бюллетени, у которых доля опорных точек, согласованных с подгонкой, меньше этого
+                                 значения, сохраняются всегда.
+        :param overlay_max_side: Размер длинной стороны изображений наложения шаблонов.
+        """
+        self.output_dir = output_dir
+        self.disk_budget_bytes = disk_budget_bytes
+        self.sample_rate = sample_rate
+        self.max_affinity_error = max_affinity_error
+        self.min_inlier_ratio = min_inlier_ratio
+        self.overlay_max_side = overlay_max_side
+
+        os.makedirs(output_dir, exist_ok=True)
+        # Учитываем артефакты, оставшиеся от предыдущих запусков
+        self.bytes_written = sum(entry.stat().st_size for entry in os.scandir(output_dir) if entry.is_file())
+
+        self.submitted = 0
+        self.dropped = 0
+        self.over_budget = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="debug-artifact-writer", daemon=True)
+        self._thread.start()
+
+    def should_sample(self, result):
+        """
+        Решает, сохранять ли артефакты для бюллетеня по результату распознавания.
+
+        :param result: Результат recognize_ballot (словарь или None).
+        """
+        if result is None or "rejected" in result:
+            return True
+        if result.get("invalid"):
+            return True
+        if result.get("affinity_accuracy", 0) > self.max_affinity_error:
+            return True
+        if result.get("inlier_ratio", 1.0) < self.min_inlier_ratio:
+            return True
+        return random.random() < self.sample_rate
+
+    def submit(self, name, image, result, rectangles_debug=None, alignments=None):
+        """
+        Ставит артефакты бюллетеня в очередь на запись. Никогда не блокирует вызывающий поток.
+
+        :param name: Имя бюллетеня (например, путь к изображению), из него формируется префикс файлов.
+        :param image: Изображение, на котором искались отметки (numpy массив или путь к файлу).
+                      Массив не копируется, поэтому после передачи его нельзя изменять.
+        :param result: Результат распознавания.
+        :param rectangles_debug: Отладочные данные по прямоугольникам из analyze_rectangles(debug_info=...).
+        :param alignments: Список словарей {'template', 'matrix', 'error', 'rectangles'} по каждому шаблону.
+        :return: True, если артефакты приняты в очередь.
+        """
+        self.submitted += 1
+        try:
+            self._queue.put_nowait((name, image, result, rectangles_debug or [], alignments or []))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout=None):
+        """Дожидается записи уже принятых артефактов и останавливает фоновый поток."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "over_budget": self.over_budget,
+            "bytes_written": self.bytes_written,
+        }
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                # Ошибка отладочной записи не должна влиять на распознавание
+                print(f"Debug artifact writer error: {e!r}")
+
+    def _save(self, file_name, data):
+        """Записывает байты в файл, если это не превышает бюджет на диске."""
+        if self.bytes_written + len(data) > self.disk_budget_bytes:
+            self.over_budget += 1
+            return False
+        with open(os.path.join(self.output_dir, file_name), "wb") as f:
+            f.write(data)
+        self.bytes_written += len(data)
+        return True
+
+    def _save_image(self, file_name, img):
+        ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        return ok and self._save(file_name, buffer.tobytes())
+
+    def _write(self, name, image, result, rectangles_debug, alignments):
+        base_name = os.path.splitext(os.path.basename(str(name)))[0]
+        # Случайный суффикс: бюллетени с одинаковым именем файла (с разных сканеров или обработчиков,
+        # пишущих в одну директорию) не должны перезаписывать артефакты друг друга
+        prefix = (f"{time.strftime('%Y%m%d-%H%M%S')}_{uuid.uuid4().hex[:8]}_"
+                  f"{re.sub(r'[^A-Za-z0-9_.-]', '_', base_name)}")
+
+        if not isinstance(image, np.ndarray):
+            image = cv2.imread(image)
+        if image is not None and image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+        # Данные контуров и результат — в одном JSON файле
+        record = {"name": str(name), "result": result, "rectangles": rectangles_debug,
+                  "alignments": [{key: value for key, value in alignment.items() if key != "rectangles"}
+                                 for alignment in alignments]}
+        if not self._save(f"{prefix}_debug.json",
+                          json.dumps(record, ensure_ascii=False, indent=2, default=json_default).encode("utf-8")):
+            return
+        if image is None:
+            return
+
+        # Вырезанные области с контурами
+        for info in rectangles_debug:
+            x1, y1, x2, y2 = info["box"]
+            crop = image[y1:y2, x1:x2].copy()
+            if crop.size == 0:
+                continue
+            cv2.drawContours(crop, [np.array(c, dtype=np.int32) for c in info["contours"]], -1, (0, 0, 255), 1)
+            cv2.drawContours(crop, [np.array(c, dtype=np.int32) for c in info["filtered_contours"]], -1, (0, 255, 0), 1)
+            self._save_image(f"{prefix}_mark_{info['index']}.jpg", crop)
+
+        # Наложения шаблонов, уменьшенные до overlay_max_side
+        height, width = image.shape[:2]
+        scale = min(1.0, self.overlay_max_side / max(height, width))
+        base = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        for alignment in alignments:
+            if alignment.get("matrix") is None:
+                continue
+            overlay = base.copy()
+            matrix = np.asarray(alignment["matrix"], dtype=np.float64)
+            for x1, y1, x2, y2 in alignment.get("rectangles", []):
+                corners = np.array([[x1, y1, 1], [x2, y1, 1], [x2, y2, 1], [x1, y2, 1]], dtype=np.float64)
+                points = (corners @ matrix.T) * scale
+                cv2.polylines(overlay, [points.astype(np.int32)], True, (255, 0, 0), 2)
+            cv2.putText(overlay, f"{alignment['template']}: error {float(alignment['error']):.2f}", (10, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+            self._save_image(f"{prefix}_align_{alignment['template']}.jpg", overlay)
+
+
+if __name__ == "__main__":
+    # Проверка записи: синтетический бюллетень с подобранным шаблоном должен дать JSON с матрицей и изображения
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        writer = DebugArtifactWriter(output_dir)
+        image = np.full((400, 300, 3), 255, dtype=np.uint8)
+        matrix = np.float32([[1, 0, 5], [0, 1, -3]])
+        alignments = [{"template": "synthetic", "matrix": matrix, "error": np.float32(1.5),
+                       "rectangles": [(50, 50, 80, 80)]}]
+        rectangles_debug = [{"index": 1, "box": (55, 47, 85, 77), "contours": [], "filtered_contours": []}]
+        # Два бюллетеня с одинаковым именем файла не должны перезаписать артефакты друг друга
+        for _ in range(2):
+            writer.submit("synthetic.jpg", image, {"mark_1": False, "invalid": True}, rectangles_debug, alignments)
+        writer.close()
+
+        files = sorted(os.listdir(output_dir))
+        with open(os.path.join(output_dir, next(f for f in files if f.endswith("_debug.json"))), encoding="utf-8") as f:
+            record = json.load(f)
+        assert np.allclose(record["alignments"][0]["matrix"], matrix), record
+        assert any(f.endswith("_align_synthetic.jpg") for f in files), files
+        assert any(f.endswith("_mark_1.jpg") for f in files), files
+        assert sum(f.endswith("_debug.json") for f in files) == 2, files
+        assert writer.bytes_written == sum(os.path.getsize(os.path.join(output_dir, f)) for f in files)
+        print(f"OK: {len(files)} files written, {writer.stats()}")
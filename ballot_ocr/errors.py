@@ -0,0 +1,54 @@
+"""
+Этот скрипт содержит типизированные исключения распознавания бюллетеней.
+Функции распознавания не завершают процесс и не возвращают None при ошибках, а выбрасывают одно из этих исключений,
+поэтому вызывающий код (пакетная обработка, обработчики очереди, сервис) сам решает, что делать с конкретным бюллетенем.
+"""
+
+
+class BallotRecognitionError(Exception):
+    """Базовое исключение распознавания бюллетеня."""
+
+
+class ImageDecodeError(BallotRecognitionError):
+    """Изображение не удалось прочитать или декодировать."""
+
+
+class ImageQualityError(BallotRecognitionError):
+    """Изображение отклонено проверкой качества до отправки в OCR."""
+
+    def __init__(self, reason, quality):
+        super().__init__(f"Image rejected by quality check: {reason}")
+        self.reason = reason
+        self.quality = quality
+
+
+class OCRError(BallotRecognitionError):
+    """Ошибка сервиса распознавания текста."""
+
+
+class TemplateError(BallotRecognitionError):
+    """Файлы шаблона отсутствуют или повреждены."""
+
+
+class AlignmentError(BallotRecognitionError):
+    """Не удалось сопоставить бюллетень с шаблоном."""
+
+
+class NoCommonWordsError(AlignmentError):
+    """У бюллетеня и шаблона нет общих ключевых слов."""
+
+
+class NoTemplateMatchError(BallotRecognitionError):
+    """Ни один шаблон не подошёл к бюллетеню."""
+
+
+class DeadlineExceeded(BallotRecognitionError):
+    """Бюджет времени на бюллетень исчерпан раньше, чем можно было получить хотя бы частичный результат."""
+
+    def __init__(self, stage):
+        super().__init__(f"Deadline exceeded at stage '{stage}'")
+        self.stage = stage
+
+
+class AlignmentPruned(AlignmentError):
+    """Шаблон пропущен без вычисления преобразования: даже в лучшем случае он не превзойдёт уже найденный."""
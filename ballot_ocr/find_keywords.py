@@ -6,12 +6,30 @@
 возвращая координаты слов в формате JSON. Она обрабатывает данные, чтобы идентифицировать и извлечь координаты слов,
 которые затем можно использовать для выравнивания или других целей обработки изображений.
 
+Если передан индекс триграмм из `fuzzy_match`, слова сопоставляются нечётко: это сохраняет опорные слова,
+в которых OCR ошибся в одном-двух символах или перепутал кириллицу с латиницей.
+
 Функция `calculate_affine_matrix` принимает пути к двум JSON-файлам,
 содержащим данные о словах и их координатах на двух изображениях, и список слов, которые нужно найти.
 Затем она вычисляет аффинную матрицу, которая может быть использована для преобразования
 координат точек с одного изображения на другое. Это особенно полезно при сопоставлении между шаблоном и целевым изображением,
 чтобы определить степень схожести между ними.
 
+Функции `calculate_affine_matrix_from_data` и `calculate_affine_matrix_from_words` делают то же самое
+для данных, уже загруженных в память. При неудаче все три функции выбрасывают AlignmentError.
+
+Функция `score_alignment` оценивает подгонку шаблона по заранее подготовленным массивам точек (`anchor_points`)
+и возвращает `AlignmentScore`: ошибку только по inliers (точкам, которые RANSAC признал согласованными),
+долю inliers и количество опорных слов. Надёжной считается подгонка не менее чем с MIN_INLIERS inliers
+и долей inliers не меньше MIN_INLIER_RATIO; надёжные подгонки всегда лучше ненадёжных. Внутри одной группы
+лучше подгонка с большим количеством inliers, а при почти равном количестве (разница не больше INLIER_TIE точек,
+т.е. одного слова) — с меньшей ошибкой по inliers, делённой на долю inliers. Одной ошибки по inliers недостаточно:
+выбросы в неё не входят, поэтому чужой шаблон с общей «шапкой» подгоняется по совпадающим словам с такой же малой
+ошибкой, как правильный.
+Если передана лучшая оценка среди уже проверенных шаблонов, а кандидат не может её превзойти даже в лучшем случае
+(inliers не больше, чем опорных точек, поэтому у кандидата с числом точек меньше best.inliers - INLIER_TIE шансов нет),
+RANSAC для него не запускается (AlignmentPruned). Поэтому шаблоны выгодно проверять в порядке убывания числа опорных слов.
+
 По завершении, если матрица была успешно вычислена, скрипт выводит её, а также отображает статистику точек,
 классифицированных как inliers, и среднюю ошибку преобразования.
 Эта информация может быть использована для оценки точности и надежности преобразования.
@@ -19,10 +37,33 @@
 
 
 import json
+from dataclasses import dataclass
+
 import cv2
 import numpy as np
 
-def extract_words_with_coordinates(json_data, words_to_find):
+from errors import AlignmentError, AlignmentPruned, NoCommonWordsError
+
+# Порог RANSAC в пикселях: точки с большей ошибкой перепроецирования считаются выбросами
+RANSAC_THRESHOLD = 3.0
+# Минимальные количество и доля inliers надёжной подгонки: по двум словам (8 точкам) почти любое преобразование
+# подобия подгоняется с малой ошибкой, поэтому нужны хотя бы три согласованных слова
+MIN_INLIERS = 12
+MIN_INLIER_RATIO = 0.6
+# Разница в количестве inliers, при которой подгонки сравниваются по ошибке (4 точки — один многоугольник слова)
+INLIER_TIE = 4
+
+def extract_words_with_coordinates(json_data, words_to_find, matcher=None):
+    """
+    Извлекает координаты ключевых слов из результата OCR.
+
+    :param json_data: Результат OCR в формате Azure ('readResult').
+    :param words_to_find: Список ключевых слов.
+    :param matcher: Необязательный fuzzy_match.TrigramIndex по тем же ключевым словам. Если задан, слова OCR,
+                    не совпавшие точно, сопоставляются нечётко; при нескольких кандидатах на одно ключевое слово
+                    выбирается самый близкий.
+    :return: Словарь {ключевое слово в нижнем регистре: boundingPolygon}.
+    """
     # Преобразуем слова для поиска в нижний регистр
     words_to_find_lower = set(word.lower() for word in words_to_find)
 
@@ -30,6 +71,8 @@ def extract_words_with_coordinates(json_data, words_to_find):
     words_with_coords = {}
     duplicate_words = set()
     word_counts = {}
+    # Расстояние редактирования, с которым найдено каждое слово (для нечёткого сопоставления)
+    match_distances = {}
 
 
 
@@ -46,6 +89,15 @@ def extract_words_with_coordinates(json_data, words_to_find):
                 if word_text in words_to_find_lower:
                     words_with_coords[word_text] = bounding_polygon
                     word_counts[word_text] = word_counts.get(word_text, 0) + 1
+                    match_distances[word_text] = 0
+                elif matcher is not None:
+                    match = matcher.match(word_text)
+                    if match is not None:
+                        keyword, distance = match
+                        # Точное или более близкое совпадение не заменяем менее точным
+                        if distance < match_distances.get(keyword, float('inf')):
+                            words_with_coords[keyword] = bounding_polygon
+                            match_distances[keyword] = distance
 
 
                 #if word_text in words_to_find_lower:
@@ -63,6 +115,9 @@ def extract_words_with_coordinates(json_data, words_to_find):
     return words_with_coords
 
 def get_polygon_points(polygon):
+    # Многоугольник из скомпилированного хранилища шаблонов уже является массивом точек
+    if isinstance(polygon, np.ndarray):
+        return polygon
     return [(point['x'], point['y']) for point in polygon]
 
 
@@ -94,68 +149,155 @@ words_to_find_standart = ['удостоверяю:',
 
 
 
-def calculate_affine_matrix(json_file1, json_file2='words_reference.json', words_to_find=words_to_find_standart):
-    """Вычисляет матрицу аффинного преобразования между двумя страницами на основе слов. Тут мы вычисляем обратную матрицу."""
-
-
-    with open(json_file1, 'r', encoding='utf-8') as file1, open(json_file2, 'r', encoding='utf-8') as file2:
-        json_data1 = json.load(file1)
-        json_data2 = json.load(file2)
-
-    # Загрузка JSON данных из двух файлов
-    #with open('results/result_page_2.json', 'r', encoding='utf-8') as file1, \
-    #     open('results/result_page_6.json', 'r', encoding='utf-8') as file2:
-    #    json_data1 = json.load(file1)
-    #    json_data2 = json.load(file2)
-
-
-    # Получение слов и их координат из каждого файла
+@dataclass(frozen=True, eq=False)
+class AlignmentScore:
+    """Оценка подгонки шаблона к бюллетеню."""
+    matrix: np.ndarray      # матрица 2x3 (шаблон -> бюллетень)
+    inlier_error: float     # средняя ошибка перепроецирования только по inliers, в пикселях
+    inlier_ratio: float     # доля inliers среди всех опорных точек
+    inliers: int            # количество inliers
+    anchors: int            # количество общих опорных слов
+    mean_error: float       # средняя ошибка по всем точкам, включая выбросы (прежняя метрика)
+
+    @property
+    def reliable(self):
+        """True, если inliers достаточно по количеству и доле."""
+        return self.inliers >= MIN_INLIERS and self.inlier_ratio >= MIN_INLIER_RATIO
+
+    @property
+    def penalized_error(self):
+        """Ошибка по inliers, увеличенная обратно пропорционально доле inliers: выбросы ухудшают оценку."""
+        return self.inlier_error / self.inlier_ratio if self.inlier_ratio else float('inf')
+
+    def beats(self, other):
+        """
+        True, если эта оценка лучше other (None считается худшей): надёжная подгонка лучше ненадёжной,
+        затем больше inliers, а при разнице не больше INLIER_TIE — меньше penalized_error.
+        """
+        if other is None:
+            return True
+        if self.reliable != other.reliable:
+            return self.reliable
+        if abs(self.inliers - other.inliers) > INLIER_TIE:
+            return self.inliers > other.inliers
+        return (self.penalized_error, -self.inliers) < (other.penalized_error, -other.inliers)
+
+
+def anchor_points(words_coordinates):
+    """
+    Преобразует словарь {слово: boundingPolygon} в словарь {слово: массив точек (N, 2) float32}.
+    Массивы из скомпилированного хранилища шаблонов не копируются.
+    """
+    return {word: np.asarray(get_polygon_points(polygon), dtype=np.float32).reshape(-1, 2)
+            for word, polygon in words_coordinates.items()}
+
+
+def _can_beat(point_count, best):
+    """
+    Верхняя оценка по AlignmentScore.beats: может ли подгонка по point_count опорным точкам оказаться лучше best.
+    Количество inliers не больше point_count, а ошибка не меньше нуля, поэтому кандидат выигрывает у подгонки
+    той же надёжности, только если point_count не меньше best.inliers - INLIER_TIE.
+    """
+    if point_count < MIN_INLIERS and best.reliable:
+        # Кандидат заведомо ненадёжен
+        return False
+    if point_count >= MIN_INLIERS and not best.reliable:
+        # Кандидат может оказаться надёжным
+        return True
+    return point_count >= best.inliers - INLIER_TIE
+
+
+def score_alignment(ref_points, points, best=None, ransac_threshold=RANSAC_THRESHOLD):
+    """
+    Оценивает подгонку шаблона по опорным словам.
+
+    :param ref_points: Точки ключевых слов шаблона {слово: массив (N, 2)} (см. anchor_points).
+    :param points: Точки тех же слов на бюллетене.
+    :param best: AlignmentScore лучшего из уже проверенных шаблонов или None.
+    :param ransac_threshold: Порог RANSAC в пикселях.
+    :return: AlignmentScore.
+    :raises NoCommonWordsError: Если общих слов нет.
+    :raises AlignmentPruned: Если шаблон не может превзойти best даже при идеальной подгонке.
+    :raises AlignmentError: Если преобразование не удалось вычислить.
+    """
+    # Сортируем, чтобы результат RANSAC не зависел от порядка слов в словаре
+    common_words = sorted(ref_points.keys() & points.keys())
+    if not common_words:
+        raise NoCommonWordsError("Нет общих слов для вычисления преобразования.")
+
+    src_points = np.concatenate([ref_points[word] for word in common_words])
+    dst_points = np.concatenate([points[word] for word in common_words])
+    if best is not None and not _can_beat(len(src_points), best):
+        raise AlignmentPruned(f"{len(src_points)} опорных точек не превзойдут лучший шаблон "
+                              f"({best.inliers} inliers, ошибка {best.inlier_error:.2f}).")
+
+    M, inliers = cv2.estimateAffinePartial2D(src_points, dst_points, method=cv2.RANSAC,
+                                             ransacReprojThreshold=ransac_threshold)
+    if M is None:
+        raise AlignmentError("Не удалось вычислить аффинное преобразование.")
+
+    mask = inliers.ravel().astype(bool) if inliers is not None else np.ones(len(src_points), dtype=bool)
+    errors = np.linalg.norm(cv2.transform(src_points[None], M)[0] - dst_points, axis=1)
+    inlier_count = int(mask.sum())
+    return AlignmentScore(
+        matrix=M,
+        inlier_error=float(errors[mask].mean()) if inlier_count else float('inf'),
+        inlier_ratio=inlier_count / len(src_points),
+        inliers=inlier_count,
+        anchors=len(common_words),
+        mean_error=float(errors.mean()),
+    )
+
+
+def calculate_affine_matrix_from_words(words_coordinates1, words_coordinates2, words_total=None):
+    """
+    Вычисляет матрицу аффинного преобразования по уже найденным ключевым словам двух страниц.
+
+    :param words_coordinates1: Словарь {слово: boundingPolygon} для первой страницы (шаблона).
+    :param words_coordinates2: Словарь {слово: boundingPolygon} для второй страницы (бюллетеня).
+    :param words_total: Общее количество искомых слов (только для сообщения о недостатке общих слов).
+    :return: Кортеж (M, inlier_error).
+    :raises NoCommonWordsError: Если общих слов нет.
+    :raises AlignmentError: Если преобразование не удалось вычислить.
+    """
+    score = score_alignment(anchor_points(words_coordinates1), anchor_points(words_coordinates2))
+    print("Доля точек, классифицированных как inliers:", score.inlier_ratio)
+    print("Средняя ошибка преобразования по inliers:", score.inlier_error)
+
+    if score.anchors < 7:
+        print(f"Найдено слов в обоих файлах: {score.anchors} из {words_total or '?'}")
+
+    return score.matrix, score.inlier_error
+
+
+def calculate_affine_matrix_from_data(json_data1, json_data2, words_to_find=words_to_find_standart):
+    """
+    Вычисляет матрицу аффинного преобразования между двумя результатами OCR, уже загруженными в память.
+
+    :return: Кортеж (M, inlier_error).
+    :raises AlignmentError: Если преобразование не удалось вычислить.
+    """
     words_coordinates1 = extract_words_with_coordinates(json_data1, words_to_find)
     words_coordinates2 = extract_words_with_coordinates(json_data2, words_to_find)
+    return calculate_affine_matrix_from_words(words_coordinates1, words_coordinates2, len(words_to_find))
 
-    # Находим пересечение слов из обоих файлов
-    common_words = set(words_coordinates1.keys()) & set(words_coordinates2.keys())
 
-    if not common_words:
-        print("Нет общих слов для вычисления преобразования.")
-        return None
-
-    # Вывод результатов
-    #print("Слова, встречающиеся в обоих файлах:")
-    #for word in common_words:
-    #    print(word)
-
-
-    # Подготовка данных для вычисления аффинного преобразования
-    src_points = np.float32([point for word in common_words for point in get_polygon_points(words_coordinates1[word])])
-    dst_points = np.float32([point for word in common_words for point in get_polygon_points(words_coordinates2[word])])
-
-    # Вычисление аффинного преобразования
-    #M, _ = cv2.estimateAffinePartial2D(src_points, dst_points)
-
-    M, inliers = cv2.estimateAffinePartial2D(src_points, dst_points)
-    if inliers is not None:
-        inlier_ratio = np.sum(inliers) / len(inliers)
-        print("Доля точек, классифицированных как inliers:", inlier_ratio)
-
-    transformed_src_points = cv2.transform(np.array([src_points]), M)[0]
-    errors = np.linalg.norm(transformed_src_points - dst_points, axis=1)
-    mean_error = np.mean(errors)
-    print("Средняя ошибка преобразования:", mean_error)
-
-
-    if len(common_words) < 7:
-        print(f"Найдено слов в обоих файлах: {len(common_words)} из {len(words_to_find)}")
+def calculate_affine_matrix(json_file1, json_file2='words_reference.json', words_to_find=words_to_find_standart):
+    """Вычисляет матрицу аффинного преобразования между двумя страницами на основе слов. Тут мы вычисляем обратную матрицу.
+    Возвращает (M, inlier_error); если преобразование вычислить не удалось, выбрасывает AlignmentError."""
 
-    return M, mean_error
+    with open(json_file1, 'r', encoding='utf-8') as file1, open(json_file2, 'r', encoding='utf-8') as file2:
+        json_data1 = json.load(file1)
+        json_data2 = json.load(file2)
 
-    # Вывод результата
-    #print("Матрица аффинного преобразования:")
-    #print(M)
+    return calculate_affine_matrix_from_data(json_data1, json_data2, words_to_find)
 
 if __name__ == "__main__":
     # Пример вызова функции
-    M = calculate_affine_matrix('results/result_page_6.json')
-    if M is not None:
+    try:
+        M, error = calculate_affine_matrix('results/result_page_6.json')
+    except AlignmentError as e:
+        print(e)
+    else:
         print("Матрица аффинного преобразования:")
         print(M)
@@ -0,0 +1,191 @@
+"""
+Этот скрипт реализует нечёткое сопоставление слов OCR с ключевыми словами шаблона.
+
+Одна ошибка OCR (латинская буква вместо похожей кириллической, потерянный символ, лишняя кавычка)
+приводит к тому, что при точном сравнении ключевое слово теряется как опорная точка. Здесь:
+
+1. Слова нормализуются: нижний регистр, удаление пунктуации, замена латинских двойников кириллическими буквами
+   (и цифр-двойников 0/3/6 в словах с кириллицей).
+2. Для ключевых слов шаблона строится индекс символьных триграмм (`TrigramIndex`).
+3. Кандидаты для слова OCR отбираются по индексу с фильтром по длине и числу общих триграмм
+   (если расстояние редактирования не больше k, строки длиной n и m имеют не меньше max(n, m) + 2 - 3k общих триграмм),
+   поэтому слово не сравнивается со всеми ключевыми словами попарно.
+4. Кандидаты проверяются ограниченным расстоянием Левенштейна: допускается одна правка (потерянный, лишний
+   или заменённый символ) после нормализации, и только вне окончания слова — последние ENDING_LENGTH букв должны совпадать.
+   Иначе другие словоформы того же слова ('представителя' и 'представителей', 'специальных' и 'специальный'),
+   которые встречаются на бюллетене в других местах, становились бы ложными опорными точками.
+
+Если два ключевых слова одинаково близки к слову OCR, совпадение считается неоднозначным и отбрасывается.
+"""
+
+
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+# Латинские буквы, которые OCR путает с кириллическими
+LATIN_TO_CYRILLIC = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м",
+    "o": "о", "p": "р", "t": "т", "x": "х", "y": "у", "ё": "е",
+})
+# Цифры, похожие на кириллические буквы; заменяются только в словах, содержащих кириллицу
+DIGITS_TO_CYRILLIC = str.maketrans({"0": "о", "3": "з", "6": "б"})
+
+# Сколько последних букв слова должно совпадать при нечётком сравнении (окончания русских словоформ)
+ENDING_LENGTH = 3
+
+PUNCTUATION = re.compile(r"[^\w/\-]+")
+CYRILLIC = re.compile(r"[а-я]")
+
+
+def normalize_word(word):
+    """
+    Приводит слово к каноническому виду для нечёткого сравнения.
+
+    :param word: Слово из OCR или ключевое слово.
+    :return: Нормализованное слово (может быть пустым).
+    """
+    word = PUNCTUATION.sub("", word.lower()).replace("_", "")
+    if not CYRILLIC.search(word) and not re.search(r"[a-z]", word):
+        # Числа и коды (например, номера счетов) не трогаем
+        return word
+    word = word.translate(LATIN_TO_CYRILLIC)
+    if CYRILLIC.search(word):
+        word = word.translate(DIGITS_TO_CYRILLIC)
+    return word
+
+
+def default_max_distance(length):
+    """
+    Допустимое расстояние редактирования в зависимости от длины слова.
+    Латинские двойники уже заменены нормализацией, поэтому одной правки хватает для потерянного или искажённого символа;
+    две правки в длинном слове уже позволяют сменить окончание.
+    """
+    if length <= ENDING_LENGTH:
+        return 0
+    return 1
+
+
+def trigrams(word):
+    """Мультимножество символьных триграмм слова с дополнением по краям."""
+    padded = f"$${word}$$"
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def bounded_levenshtein(a, b, max_distance):
+    """
+    Вычисляет расстояние Левенштейна, если оно не больше max_distance, иначе возвращает max_distance + 1.
+    Считается только полоса шириной 2 * max_distance + 1 вокруг диагонали.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if a == b:
+        return 0
+    over = max_distance + 1
+    previous = [j if j <= max_distance else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [over] * (len(b) + 1)
+        if i <= max_distance:
+            current[0] = i
+        low, high = max(1, i - max_distance), min(len(b), i + max_distance)
+        for j in range(low, high + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost, over)
+        if min(current[max(0, low - 1):high + 1]) > max_distance:
+            return over
+        previous = current
+    return min(previous[len(b)], over)
+
+
+class TrigramIndex:
+    """
+    Индекс триграмм для набора ключевых слов одного шаблона.
+    Возвращает для слова OCR ключевое слово шаблона (в нижнем регистре, как в extract_words_with_coordinates).
+    """
+
+    def __init__(self, keywords, max_distance=default_max_distance):
+        """
+        :param keywords: Ключевые слова шаблона.
+        :param max_distance: Функция длина -> допустимое расстояние редактирования.
+        """
+        self.max_distance = max_distance
+        self.keywords = []
+        self.normalized = []
+        self.exact = {}
+        self.postings = defaultdict(list)
+
+        ambiguous = set()
+        for keyword in keywords:
+            norm = normalize_word(keyword)
+            if not norm:
+                continue
+            if norm in self.exact:
+                # Два ключевых слова совпадают после нормализации — их нельзя различить
+                ambiguous.add(norm)
+                continue
+            keyword_id = len(self.keywords)
+            self.keywords.append(keyword.lower())
+            self.normalized.append(norm)
+            self.exact[norm] = keyword_id
+            for gram, count in trigrams(norm).items():
+                self.postings[gram].append((keyword_id, count))
+
+        for norm in ambiguous:
+            self.exact[norm] = None
+
+    def match(self, word):
+        """
+        Находит ключевое слово, ближайшее к слову OCR.
+
+        :param word: Слово из OCR.
+        :return: Кортеж (ключевое слово, расстояние) или None, если подходящего или однозначного совпадения нет.
+        """
+        norm = normalize_word(word)
+        if not norm:
+            return None
+        if norm in self.exact:
+            keyword_id = self.exact[norm]
+            return None if keyword_id is None else (self.keywords[keyword_id], 0)
+
+        k = self.max_distance(len(norm))
+        if k == 0:
+            return None
+
+        # Подсчёт общих триграмм только по спискам из индекса
+        shared = defaultdict(int)
+        for gram, count in trigrams(norm).items():
+            for keyword_id, keyword_count in self.postings.get(gram, ()):
+                shared[keyword_id] += min(count, keyword_count)
+
+        best, best_distance, tie = None, k + 1, False
+        for keyword_id, common in shared.items():
+            candidate = self.normalized[keyword_id]
+            allowed = min(k, self.max_distance(len(candidate)))
+            if abs(len(candidate) - len(norm)) > allowed:
+                continue
+            if common < max(len(candidate), len(norm)) + 2 - 3 * allowed:
+                continue
+            distance = bounded_levenshtein(norm, candidate, allowed)
+            if distance > allowed:
+                continue
+            if norm[-ENDING_LENGTH:] != candidate[-ENDING_LENGTH:]:
+                # Отличается окончание — это другая словоформа, а не ошибка OCR
+                continue
+            if distance < best_distance:
+                best, best_distance, tie = keyword_id, distance, False
+            elif distance == best_distance:
+                tie = True
+
+        if best is None or tie:
+            return None
+        return self.keywords[best], best_distance
+
+
+@lru_cache(maxsize=256)
+def _get_index(keywords):
+    return TrigramIndex(keywords)
+
+
+def get_index(keywords):
+    """Возвращает (кешированный) индекс триграмм для набора ключевых слов."""
+    return _get_index(tuple(keywords))
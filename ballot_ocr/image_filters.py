@@ -0,0 +1,189 @@
+"""
+Этот скрипт реализует этап предварительной обработки изображений перед OCR и перед поиском отметок.
+Цепочка фильтров задаётся декларативно списком имён, например ["contrast", "sharpen", "black_white", "rotate_90"],
+и применяется к уже декодированному numpy массиву в памяти, без промежуточных файлов на диске.
+
+Доступные фильтры перечислены в словаре FILTERS:
+
+- `contrast`: выравнивание контраста (CLAHE).
+- `sharpen`: повышение резкости (нерезкое маскирование).
+- `black_white`: адаптивная бинаризация.
+- `denoise`: медианное сглаживание шума.
+- `rotate_90`, `rotate_180`, `rotate_270`: поворот по часовой стрелке.
+- `auto_orient`: автоматическое определение ориентации по профилям проекций (исправляет поворот на 90 градусов).
+
+Функция `preprocess_image` может запоминать промежуточные результаты в словаре, который живёт в пределах обработки
+одного бюллетеня: если цепочки для OCR и для отметок начинаются одинаково, общий префикс обрабатывается один раз.
+Между бюллетенями ничего не хранится — каждый снимок уникален, а полноразмерный кадр 12 Мп занимает около 36 МБ.
+
+Геометрические фильтры (повороты) меняют систему координат изображения. Координаты OCR и прямоугольники отметок
+должны относиться к одному и тому же кадру, поэтому у цепочек для OCR и для отметок геометрическая часть должна совпадать
+(см. `check_geometry_compatible`).
+"""
+
+
+import cv2
+import numpy as np
+
+
+def _to_gray(img):
+    """Возвращает серую версию изображения (без копирования, если оно уже серое)."""
+    if img.ndim == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
+
+
+def contrast(img):
+    """Выравнивает контраст с помощью CLAHE. Для цветного изображения обрабатывается только канал яркости."""
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    if img.ndim == 2:
+        return clahe.apply(img)
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    lab[:, :, 0] = clahe.apply(lab[:, :, 0])
+    return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+
+
+def sharpen(img):
+    """Повышает резкость методом нерезкого маскирования."""
+    blurred = cv2.GaussianBlur(img, (0, 0), 3)
+    return cv2.addWeighted(img, 1.5, blurred, -0.5, 0)
+
+
+def black_white(img):
+    """Бинаризует изображение адаптивным порогом. Результат — серое изображение из 0 и 255."""
+    return cv2.adaptiveThreshold(_to_gray(img), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+
+
+def denoise(img):
+    """Убирает мелкий шум медианным фильтром."""
+    return cv2.medianBlur(img, 3)
+
+
+def rotate_90(img):
+    return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+
+
+def rotate_180(img):
+    return cv2.rotate(img, cv2.ROTATE_180)
+
+
+def rotate_270(img):
+    return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+
+def detect_orientation(img, max_side=512):
+    """
+    Определяет, повёрнут ли текст на 90 градусов.
+    Строки текста дают резкие перепады суммы чернил по строкам изображения, поэтому дисперсия профиля
+    горизонтальной проекции для правильно ориентированного листа больше, чем вертикальной.
+    Поворот на 180 градусов таким способом не различается.
+
+    :param img: Изображение BGR или серое.
+    :param max_side: Размер, до которого изображение уменьшается перед анализом.
+    :return: Угол поворота по часовой стрелке (0 или 90), который нужно применить для выравнивания.
+    """
+    gray = _to_gray(img)
+    height, width = gray.shape
+    scale = max_side / max(height, width)
+    if scale < 1:
+        gray = cv2.resize(gray, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    ink = ink.astype(np.float32)
+    rows_variance = np.var(ink.mean(axis=1))
+    cols_variance = np.var(ink.mean(axis=0))
+    return 90 if cols_variance > rows_variance else 0
+
+
+def auto_orient(img):
+    """Поворачивает изображение так, чтобы строки текста были горизонтальными."""
+    if detect_orientation(img) == 90:
+        return rotate_90(img)
+    return img
+
+
+# Реестр фильтров: имя в цепочке -> функция, принимающая и возвращающая numpy массив
+FILTERS = {
+    "contrast": contrast,
+    "sharpen": sharpen,
+    "black_white": black_white,
+    "denoise": denoise,
+    "rotate_90": rotate_90,
+    "rotate_180": rotate_180,
+    "rotate_270": rotate_270,
+    "auto_orient": auto_orient,
+}
+
+# Фильтры, меняющие систему координат изображения
+GEOMETRIC_FILTERS = {"rotate_90", "rotate_180", "rotate_270", "auto_orient"}
+
+
+def apply_filters(img, filters):
+    """
+    Последовательно применяет цепочку фильтров к изображению.
+
+    :param img: Декодированное изображение (numpy массив).
+    :param filters: Список имён фильтров из FILTERS.
+    :return: Обработанное изображение.
+    """
+    for name in filters:
+        if name not in FILTERS:
+            raise ValueError(f"Unknown image filter '{name}'. Available filters: {', '.join(FILTERS)}")
+        img = FILTERS[name](img)
+    return img
+
+
+def check_geometry_compatible(ocr_filters, marks_filters):
+    """
+    Проверяет, что цепочки для OCR и для отметок одинаково меняют геометрию изображения.
+    Иначе аффинная матрица, найденная по координатам OCR, не подойдёт к изображению для поиска отметок.
+
+    :param ocr_filters: Цепочка фильтров для ветки OCR.
+    :param marks_filters: Цепочка фильтров для ветки поиска отметок.
+    """
+    ocr_geometry = [name for name in ocr_filters or [] if name in GEOMETRIC_FILTERS]
+    marks_geometry = [name for name in marks_filters or [] if name in GEOMETRIC_FILTERS]
+    if ocr_geometry != marks_geometry:
+        raise ValueError(f"Geometric filters differ between OCR chain {ocr_geometry} and marks chain {marks_geometry}")
+
+
+def preprocess_image(img, filters, memo=None):
+    """
+    Применяет цепочку фильтров. Если передан словарь memo, промежуточные результаты запоминаются в нём по префиксу
+    цепочки, и следующая цепочка для того же изображения продолжает обработку с самого длинного общего префикса.
+
+    :param img: Декодированное изображение (numpy массив).
+    :param filters: Список имён фильтров. Пустая цепочка возвращает исходное изображение.
+    :param memo: Словарь результатов для этого изображения (живёт в пределах обработки одного бюллетеня) или None.
+    :return: Обработанное изображение.
+    """
+    if not filters:
+        return img
+    if memo is None:
+        return apply_filters(img, filters)
+
+    chain = tuple(filters)
+    done, result = 0, img
+    for length in range(len(chain), 0, -1):
+        if chain[:length] in memo:
+            done, result = length, memo[chain[:length]]
+            break
+    for length in range(done + 1, len(chain) + 1):
+        result = apply_filters(result, chain[length - 1:length])
+        memo[chain[:length]] = result
+    return result
+
+
+def encode_image(img, ext=".jpg", quality=95):
+    """
+    Кодирует изображение в байты для отправки в OCR без сохранения на диск.
+
+    :param img: Изображение (numpy массив).
+    :param ext: Формат кодирования.
+    :param quality: Качество JPEG.
+    :return: Байты закодированного изображения.
+    """
+    ok, buffer = cv2.imencode(ext, img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError(f"Could not encode image to '{ext}'")
+    return buffer.tobytes()
@@ -0,0 +1,224 @@
+"""
+Этот скрипт реализует быструю локальную проверку качества фотографии бюллетеня перед отправкой в Azure OCR.
+Размытые, тёмные или обрезанные снимки всё равно проходят полный вызов Azure, а затем отбрасываются
+в `calculate_affine_matrix` (нет общих слов) или дают большую ошибку подгонки. Проверка позволяет не платить за такие вызовы.
+
+Изображение декодируется в половинном разрешении (OpenCV уменьшает JPEG прямо при декодировании).
+Резкость считается по нему, потому что при сильном уменьшении размытие мелкого текста пропадает.
+Остальные метрики считаются по уменьшенной копии (по умолчанию не больше 512 пикселей по длинной стороне).
+Вся проверка занимает несколько десятков миллисекунд на снимок 12 Мп:
+
+- `sharpness`: дисперсия лапласиана на изображении в половинном разрешении. Лист делится на sharpness_grid x sharpness_grid
+  плиток и берётся самая резкая, чтобы пустые поля не занижали оценку.
+- `brightness`, `dark_fraction`, `bright_fraction`: средняя яркость и доли «провалившихся» в чёрное и белых пикселей.
+  Белая бумага чистого скана почти вся лежит в 250-255, поэтому доля белых пикселей сама по себе не означает пересвет.
+- `text_contrast`: разница между уровнем бумаги (медиана) и уровнем текста (1-й перцентиль) внутри области листа
+  на изображении в половинном разрешении. При пересвете текст выцветает и контраст падает — это и есть `overexposed`.
+- `page_coverage`: доля кадра, занятая светлой областью листа.
+- `border_contact`: сколько сторон кадра касается лист (1-3 стороны обычно означают, что лист обрезан).
+
+Результат проверки — словарь с флагом `passed`, кодом причины отказа `reason` и списком всех замечаний `flags`.
+Какие замечания приводят к отказу, а какие только помечаются, задаётся в конфигурации.
+"""
+
+
+import cv2
+import numpy as np
+
+# Коды причин
+REASON_UNREADABLE = "unreadable"
+REASON_BLURRY = "blurry"
+REASON_TOO_DARK = "too_dark"
+REASON_OVEREXPOSED = "overexposed"
+REASON_LOW_COVERAGE = "low_coverage"
+REASON_CROPPED = "cropped"
+
+# Настройки проверки по умолчанию. Пороги экспозиции и покрытия подобраны для изображения, уменьшенного до max_side.
+# Порог резкости относится к изображению размером до sharpness_max_side. Он подобран на синтетической странице
+# 3000x2200 с текстом толщиной 2 пикселя, размытой фильтром Гаусса (оценка самой резкой плитки):
+# без размытия ~9000, ядро 7x7 ~1700, 11x11 ~590, 15x15 ~190 — проходят; 21x21 (sigma ~3.5 px) ~48, 31x31 ~13 — отклоняются.
+# На настоящих отказах порог стоит перепроверить: python image_quality.py <снимки>.
+DEFAULT_QUALITY_CONFIG = {
+    "max_side": 512,
+    "sharpness_max_side": 1600,
+    "sharpness_grid": 4,
+    "min_sharpness": 100.0,
+    "min_brightness": 60.0,
+    "max_dark_fraction": 0.5,
+    # Чистый скан: бумага ~250, текст ~30, контраст ~220. Пересвеченное фото: бумага 255, текст выцвел до 180-200.
+    "min_text_contrast": 80.0,
+    "min_page_coverage": 0.25,
+    # Замечания, при которых изображение отклоняется. Остальные только попадают в flags.
+    "reject": (REASON_UNREADABLE, REASON_BLURRY, REASON_TOO_DARK, REASON_OVEREXPOSED, REASON_LOW_COVERAGE),
+}
+
+
+def load_gray_detail(image, max_side=DEFAULT_QUALITY_CONFIG["sharpness_max_side"]):
+    """
+    Загружает изображение в сером виде с разрешением, достаточным для оценки резкости текста.
+    OpenCV декодирует JPEG с понижением разрешения в 2 раза, что быстрее полного декодирования.
+
+    :param image: Путь к изображению, байты закодированного изображения или декодированное изображение.
+    :param max_side: Максимальный размер длинной стороны результата.
+    :return: Серое изображение uint8 или None, если изображение не удалось прочитать.
+    """
+    if isinstance(image, np.ndarray):
+        if image.size == 0:
+            return None
+        return downscale_gray(image, max_side)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        gray = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    else:
+        gray = cv2.imread(image, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None:
+        return None
+    return downscale_gray(gray, max_side)
+
+
+def downscale_gray(img, max_side=DEFAULT_QUALITY_CONFIG["max_side"]):
+    """
+    Переводит изображение в градации серого и уменьшает его так, чтобы длинная сторона не превышала max_side.
+
+    :param img: Изображение BGR или серое.
+    :param max_side: Максимальный размер длинной стороны.
+    :return: Серое изображение uint8.
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    height, width = img.shape[:2]
+    scale = max_side / max(height, width)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def tile_sharpness(gray, grid=DEFAULT_QUALITY_CONFIG["sharpness_grid"]):
+    """
+    Оценивает резкость как наибольшую по плиткам дисперсию лапласиана.
+
+    :param gray: Серое изображение uint8.
+    :param grid: Количество плиток по каждой стороне.
+    """
+    laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+    height, width = laplacian.shape
+    grid = max(1, min(grid, height, width))
+    th, tw = height // grid, width // grid
+    # Плитки одного размера складываются в массив (grid, th, grid, tw), дисперсия считается по осям плитки
+    tiles = laplacian[:th * grid, :tw * grid].reshape(grid, th, grid, tw)
+    return float(tiles.var(axis=(1, 3)).max())
+
+
+def _percentile(hist, fraction):
+    """
+    Возвращает уровень яркости, ниже которого лежит заданная доля пикселей гистограммы.
+    """
+    cumulative = np.cumsum(hist)
+    return int(np.searchsorted(cumulative, fraction * cumulative[-1]))
+
+
+def compute_quality_metrics(gray, detail=None, sharpness_grid=DEFAULT_QUALITY_CONFIG["sharpness_grid"]):
+    """
+    Вычисляет метрики качества.
+
+    :param gray: Уменьшенное серое изображение uint8 (для экспозиции и области листа).
+    :param detail: Серое изображение в большем разрешении для оценки резкости; по умолчанию используется gray.
+    :param sharpness_grid: Количество плиток по каждой стороне для оценки резкости.
+    :return: Словарь с метриками.
+    """
+    if detail is None:
+        detail = gray
+    sharpness = tile_sharpness(detail, sharpness_grid)
+
+    # Экспозиция: гистограмма за один проход вместо нескольких сравнений по всему массиву
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    levels = np.arange(256)
+    brightness = float((hist * levels).sum() / total)
+    dark_fraction = float(hist[:30].sum() / total)
+    bright_fraction = float(hist[250:].sum() / total)
+
+    # Область листа: порог Оцу по размытому изображению, затем крупнейшая связная светлая область
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, paper = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(paper, connectivity=4)
+
+    page_coverage = 0.0
+    border_contact = 0
+    height, width = gray.shape
+    page_region = detail
+    if count > 1:
+        # Нулевая метка — фон, ищем крупнейшую светлую компоненту
+        largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        x, y, w, h, area = stats[largest]
+        page_coverage = float(area / (height * width))
+        border_contact = int(x <= 1) + int(y <= 1) + int(x + w >= width - 1) + int(y + h >= height - 1)
+        # Прямоугольник листа переносится на изображение в большем разрешении: на уменьшенном тонкий текст размывается
+        sy, sx = detail.shape[0] / height, detail.shape[1] / width
+        page_region = detail[int(y * sy):int((y + h) * sy), int(x * sx):int((x + w) * sx)]
+
+    # Контраст текста внутри листа: медиана — уровень бумаги, 1-й перцентиль — уровень текста
+    page_hist = np.bincount(page_region.ravel(), minlength=256)
+    text_contrast = float(_percentile(page_hist, 0.5) - _percentile(page_hist, 0.01))
+
+    return {
+        "sharpness": sharpness,
+        "brightness": brightness,
+        "dark_fraction": dark_fraction,
+        "bright_fraction": bright_fraction,
+        "text_contrast": text_contrast,
+        "page_coverage": page_coverage,
+        "border_contact": border_contact,
+    }
+
+
+def check_image_quality(image, config=None):
+    """
+    Проверяет, стоит ли отправлять изображение на распознавание.
+
+    :param image: Путь к изображению, байты закодированного изображения или декодированное изображение (numpy массив).
+    :param config: Словарь с настройками, переопределяющими DEFAULT_QUALITY_CONFIG.
+    :return: Словарь с полями 'passed', 'reason' (код первой причины отказа или None), 'flags' и 'metrics'.
+    """
+    cfg = dict(DEFAULT_QUALITY_CONFIG)
+    if config:
+        cfg.update(config)
+
+    detail = load_gray_detail(image, cfg["sharpness_max_side"])
+    if detail is None or detail.size == 0:
+        return {"passed": False, "reason": REASON_UNREADABLE, "flags": [REASON_UNREADABLE], "metrics": {}}
+
+    gray = downscale_gray(detail, cfg["max_side"])
+    metrics = compute_quality_metrics(gray, detail, cfg["sharpness_grid"])
+
+    flags = []
+    if metrics["sharpness"] < cfg["min_sharpness"]:
+        flags.append(REASON_BLURRY)
+    if metrics["brightness"] < cfg["min_brightness"] or metrics["dark_fraction"] > cfg["max_dark_fraction"]:
+        flags.append(REASON_TOO_DARK)
+    if metrics["text_contrast"] < cfg["min_text_contrast"]:
+        flags.append(REASON_OVEREXPOSED)
+    if metrics["page_coverage"] < cfg["min_page_coverage"]:
+        flags.append(REASON_LOW_COVERAGE)
+    # Скан касается всех четырёх сторон, аккуратное фото — ни одной. Промежуточные случаи — признак обрезки.
+    if 0 < metrics["border_contact"] < 4:
+        flags.append(REASON_CROPPED)
+
+    rejected = [flag for flag in flags if flag in cfg["reject"]]
+
+    return {
+        "passed": not rejected,
+        "reason": rejected[0] if rejected else None,
+        "flags": flags,
+        "metrics": metrics,
+    }
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    for path in sys.argv[1:] or ["test_ballots/new_ballot.jpg"]:
+        start = time.perf_counter()
+        quality = check_image_quality(path)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"{path}: {quality} ({elapsed_ms:.1f} ms)")
@@ -0,0 +1,13 @@
+"""
+Этот скрипт содержит общие вспомогательные функции для записи результатов распознавания в JSON.
+Результаты содержат массивы и числа numpy (аффинная матрица 2x3, ошибка подгонки типа float32),
+которые стандартный модуль json сериализовать не умеет.
+"""
+
+
+def json_default(obj):
+    """Позволяет сериализовать в JSON массивы и числа numpy (например, аффинную матрицу 2x3 или ошибку типа float32)."""
+    # tolist подходит и массивам любого размера, и скалярам numpy; item() работает только для массивов из одного элемента
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,514 @@
+"""
+Этот скрипт выполняет нагрузочное тестирование всего конвейера распознавания без обращения к настоящему Azure.
+
+Он поднимает локальный фиктивный сервис Read (`FakeReadServer`), который отвечает на запросы анализа изображений
+записанными или синтезированными результатами OCR в формате Azure ('readResult'). Сервис работает в отдельном процессе
+(`FakeReadServerProcess`), чтобы кодирование JSON и ожидание ответов не конкурировали с распознаванием за GIL,
+а CPU и RSS в отчёте относились только к конвейеру. Его можно запустить и отдельно (--serve-only),
+а нагрузку направить на уже работающий адрес (--endpoint):
+
+- записанные ответы берутся из директории с JSON файлами (например, ballots_jsons);
+- синтезированные ответы строятся из эталонных бюллетеней шаблонов со случайным небольшим поворотом, масштабом и сдвигом.
+
+Задержка ответа задаётся распределением (fixed:200, uniform:100,400, lognormal:250,0.5 — в миллисекундах),
+ограничение частоты запросов (rate_limit) имитирует троттлинг Azure ответом 429 с заголовком Retry-After,
+а error_rate задаёт долю ответов 500.
+
+Запросы к сервису по умолчанию выполняет рабочий клиент `pdf_vision.analyze_image_data` (Azure SDK с его политикой
+повторов и таймаутами), которому передаётся адрес фиктивного сервиса. Клиент `http_ocr` (--client http) — упрощённый
+клиент на requests для окружения без Azure SDK; политику повторов SDK он не проверяет.
+
+Нагрузка подаётся на `recognizer.recognize` по одному из профилей:
+
+- закрытый цикл (closed): N параллельных клиентов, каждый отправляет следующий бюллетень сразу после ответа;
+- открытый цикл (open): бюллетени поступают пуассоновским потоком с заданной интенсивностью независимо от ответов.
+  Задержка отсчитывается от запланированного момента поступления, поэтому очередь перед конвейером тоже учитывается.
+
+Отчёт содержит пропускную способность, перцентили задержки p50/p95/p99, количество ошибок по типам
+и временной ряд загрузки CPU и RSS процесса.
+
+Пример:
+    python load_test.py --images "test_ballots/*.jpg" --profile open --rate 50 --duration 60 --latency lognormal:300,0.4
+"""
+
+
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+from deadline import Deadline
+from recognizer import recognize
+from template_store import load_templates
+
+
+def parse_latency(spec):
+    """
+    Разбирает описание распределения задержки и возвращает функцию, выдающую задержку в секундах.
+
+    :param spec: 'fixed:MS', 'uniform:MIN_MS,MAX_MS' или 'lognormal:MEDIAN_MS,SIGMA'.
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda: values[0] / 1000
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma) / 1000
+    raise ValueError(f"Unknown latency distribution '{spec}'")
+
+
+def load_recorded_payloads(directory):
+    """Загружает записанные результаты OCR из JSON файлов директории."""
+    payloads = []
+    for path in sorted(glob(os.path.join(directory, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if "readResult" in data:
+            payloads.append(data)
+    return payloads
+
+
+def synthesize_payload(ref_json, max_angle=3.0, max_scale=0.1, max_shift=40.0):
+    """
+    Строит результат OCR из эталонного, смещая все многоугольники слов случайным преобразованием подобия.
+
+    :param ref_json: Эталонный результат OCR шаблона.
+    :return: Новый результат OCR в том же формате.
+    """
+    angle = math.radians(random.uniform(-max_angle, max_angle))
+    scale = 1 + random.uniform(-max_scale, max_scale)
+    shift_x, shift_y = random.uniform(-max_shift, max_shift), random.uniform(-max_shift, max_shift)
+    cos_a, sin_a = scale * math.cos(angle), scale * math.sin(angle)
+
+    def move(polygon):
+        return [{"x": round(cos_a * p["x"] - sin_a * p["y"] + shift_x),
+                 "y": round(sin_a * p["x"] + cos_a * p["y"] + shift_y)} for p in polygon]
+
+    blocks = []
+    for block in ref_json["readResult"]["blocks"]:
+        lines = []
+        for line in block["lines"]:
+            words = [dict(word, boundingPolygon=move(word["boundingPolygon"])) for word in line["words"]]
+            lines.append(dict(line, boundingPolygon=move(line["boundingPolygon"]), words=words))
+        blocks.append(dict(block, lines=lines))
+    return dict(ref_json, readResult=dict(ref_json["readResult"], blocks=blocks))
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов: rate запросов в секунду с запасом burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeReadServer:
+    """
+    Локальный фиктивный сервис Azure Image Analysis (Read).
+    Принимает POST /computervision/imageanalysis:analyze с байтами изображения и возвращает результат OCR.
+    """
+
+    def __init__(self, payloads=None, ref_jsons=None, latency="fixed:0", rate_limit=None, error_rate=0.0,
+                 host="127.0.0.1", port=0):
+        """
+        :param payloads: Записанные результаты OCR; выбираются случайно.
+        :param ref_jsons: Эталонные результаты OCR шаблонов для синтеза, если payloads не заданы.
+        :param latency: Распределение задержки ответа (см. parse_latency).
+        :param rate_limit: Максимальное количество запросов в секунду; превышение даёт ответ 429.
+        :param error_rate: Доля запросов, на которые возвращается ошибка 500.
+        """
+        if not payloads and not ref_jsons:
+            raise ValueError("Either recorded payloads or reference JSONs for synthesis are required")
+        self.payloads = payloads or []
+        self.ref_jsons = ref_jsons or []
+        self.latency = parse_latency(latency)
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.error_rate = error_rate
+        self.counters = {"requests": 0, "throttled": 0, "errors": 0}
+        self._counters_lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, body, headers = server.respond()
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _count(self, name):
+        with self._counters_lock:
+            self.counters[name] += 1
+
+    def respond(self):
+        """Формирует ответ на один запрос: (статус, тело, заголовки)."""
+        self._count("requests")
+        if self.bucket is not None and not self.bucket.take():
+            self._count("throttled")
+            return 429, {"error": {"code": "429", "message": "Rate limit is exceeded."}}, {"Retry-After": "1"}
+        time.sleep(self.latency())
+        if random.random() < self.error_rate:
+            self._count("errors")
+            return 500, {"error": {"code": "InternalServerError", "message": "Synthetic failure."}}, {}
+        if self.payloads:
+            return 200, random.choice(self.payloads), {}
+        return 200, synthesize_payload(random.choice(self.ref_jsons)), {}
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return False
+
+
+def _serve_fake_endpoint(connection, server_args):
+    """Точка входа процесса фиктивного сервиса: сообщает адрес, ждёт команды остановки и возвращает счётчики."""
+    with FakeReadServer(**server_args) as server:
+        connection.send(server.endpoint)
+        connection.recv()
+        connection.send(dict(server.counters))
+
+
+class FakeReadServerProcess:
+    """
+    Запускает FakeReadServer в отдельном процессе.
+
+    Использование:
+        with FakeReadServerProcess(ref_jsons=ref_jsons, latency="fixed:200") as server:
+            ocr = sdk_ocr(server.endpoint)
+            ...
+        print(server.counters)
+    """
+
+    def __init__(self, **server_args):
+        """
+        :param server_args: Параметры FakeReadServer.
+        """
+        self.server_args = server_args
+        self.endpoint = None
+        self.counters = {}
+        self._connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve_fake_endpoint, args=(child_connection, server_args),
+                                                name="fake-read-server", daemon=True)
+
+    def __enter__(self):
+        self._process.start()
+        self.endpoint = self._connection.recv()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._connection.send("stop")
+        self.counters = self._connection.recv()
+        self._process.join()
+        return False
+
+
+def sdk_ocr(endpoint):
+    """
+    Возвращает функцию OCR, использующую рабочий клиент pdf_vision.analyze_image_data (Azure SDK) с адресом endpoint.
+    """
+    # Импорт здесь: Azure SDK и azure_credentials нужны только для этого клиента
+    from pdf_vision import analyze_image_data
+
+    return functools.partial(analyze_image_data, service_endpoint=endpoint)
+
+
+def http_ocr(endpoint, max_retries=3):
+    """
+    Возвращает функцию OCR, обращающуюся к REST API анализа изображений по адресу endpoint.
+    Ответы 429 повторяются после паузы из заголовка Retry-After, как это делает клиент Azure SDK.
+    Остальные особенности политики повторов SDK этот клиент не воспроизводит, для них используйте sdk_ocr.
+    """
+    url = f"{endpoint}/computervision/imageanalysis:analyze?features=read&api-version=2023-10-01"
+    local = threading.local()
+
+    def ocr(image_data, timeout=None):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        for attempt in range(max_retries + 1):
+            response = session.post(url, data=image_data, headers={"Content-Type": "application/octet-stream"},
+                                    timeout=timeout)
+            if response.status_code == 429 and attempt < max_retries:
+                time.sleep(float(response.headers.get("Retry-After", 1)))
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    return ocr
+
+
+def read_process_usage():
+    """Возвращает (процессорное время процесса в секундах, RSS в мегабайтах)."""
+    times = os.times()
+    cpu = times.user + times.system
+    try:
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        rss_mb = rss_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        import resource
+        rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return cpu, rss_mb
+
+
+class ResourceSampler:
+    """Фоновый поток, периодически записывающий загрузку CPU, RSS и число завершённых запросов."""
+
+    def __init__(self, stats, interval=1.0):
+        self.stats = stats
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        start = time.monotonic()
+        last_time, (last_cpu, _) = start, read_process_usage()
+        last_done = 0
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            cpu, rss_mb = read_process_usage()
+            done = self.stats.completed()
+            self.samples.append({
+                "t": round(now - start, 2),
+                "cpu_percent": round(100 * (cpu - last_cpu) / (now - last_time), 1),
+                "rss_mb": round(rss_mb, 1),
+                "throughput": round((done - last_done) / (now - last_time), 2),
+            })
+            last_time, last_cpu, last_done = now, cpu, done
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+class LoadStats:
+    """Потокобезопасный сбор задержек и ошибок."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, latency, error=None):
+        with self._lock:
+            self.latencies.append(latency)
+            if error is not None:
+                name = type(error).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def completed(self):
+        with self._lock:
+            return len(self.latencies)
+
+
+def run_load(images, templates, ocr, profile="closed", concurrency=8, rate=10.0, duration=30.0, recognize_kwargs=None,
+             budget_seconds=None):
+    """
+    Подаёт нагрузку на recognize и возвращает отчёт.
+
+    :param images: Список байтов изображений; бюллетени берутся по кругу.
+    :param templates: Шаблоны для recognize.
+    :param ocr: Функция OCR (обычно sdk_ocr к FakeReadServerProcess).
+    :param profile: 'closed' — закрытый цикл с concurrency клиентами, 'open' — пуассоновский поток с интенсивностью rate.
+    :param concurrency: Количество клиентов (closed) или максимальное число одновременных запросов (open).
+    :param rate: Интенсивность поступления бюллетеней в секунду (open).
+    :param duration: Длительность теста в секундах.
+    :param recognize_kwargs: Дополнительные параметры recognize.
+    :param budget_seconds: Бюджет времени на бюллетень (deadline.Deadline создаётся при поступлении бюллетеня).
+    :return: Словарь с отчётом.
+    """
+    recognize_kwargs = recognize_kwargs or {}
+    stats = LoadStats()
+    deadline = time.monotonic() + duration
+    counter = iter(range(1 << 62))
+    counter_lock = threading.Lock()
+
+    def next_image():
+        with counter_lock:
+            return images[next(counter) % len(images)]
+
+    def one(scheduled):
+        error = None
+        try:
+            kwargs = dict(recognize_kwargs)
+            if budget_seconds is not None:
+                # Время в очереди открытого профиля тоже входит в бюджет
+                kwargs["deadline"] = Deadline(budget_seconds - (time.monotonic() - scheduled))
+            recognize(next_image(), templates, ocr, **kwargs)
+        except Exception as e:
+            error = e
+        stats.record(time.monotonic() - scheduled, error)
+
+    start = time.monotonic()
+    with ResourceSampler(stats) as sampler:
+        if profile == "closed":
+            def client():
+                while time.monotonic() < deadline:
+                    one(time.monotonic())
+
+            threads = [threading.Thread(target=client) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elif profile == "open":
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                scheduled = time.monotonic()
+                while scheduled < deadline:
+                    delay = scheduled - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    executor.submit(one, scheduled)
+                    scheduled += random.expovariate(rate)
+        else:
+            raise ValueError(f"Unknown load profile '{profile}'")
+    elapsed = time.monotonic() - start
+
+    latencies = np.array(stats.latencies) * 1000 if stats.latencies else np.zeros(1)
+    total = len(stats.latencies)
+    failed = sum(stats.errors.values())
+    return {
+        "profile": profile,
+        "requests": total,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(total / elapsed, 2),
+        "latency_ms": {name: round(float(np.percentile(latencies, q)), 1)
+                       for name, q in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100))},
+        "error_rate": round(failed / total, 4) if total else 0.0,
+        "errors": stats.errors,
+        "timeline": sampler.samples,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for ballot recognition against a local fake OCR endpoint")
+    parser.add_argument("--images", help="glob of ballot images")
+    parser.add_argument("--templates", default="templates")
+    parser.add_argument("--recorded", help="directory with recorded OCR JSON responses; synthesized if omitted")
+    parser.add_argument("--latency", default="lognormal:300,0.4", help="fixed:MS | uniform:MIN,MAX | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--rate-limit", type=float, help="fake endpoint requests per second before 429")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--serve-only", action="store_true", help="only run the fake endpoint until interrupted")
+    parser.add_argument("--port", type=int, default=0, help="fake endpoint port (with --serve-only)")
+    parser.add_argument("--endpoint", help="send load to this running endpoint instead of starting a fake one")
+    parser.add_argument("--client", choices=["sdk", "http"], default="sdk",
+                        help="sdk: production Azure SDK client; http: lightweight client without SDK retry policy")
+    parser.add_argument("--profile", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=10.0, help="arrivals per second for the open profile")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--no-quality-check", action="store_true")
+    parser.add_argument("--budget", type=float, help="per-ballot latency budget in seconds")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    server_args = None
+    if args.serve_only or not args.endpoint:
+        payloads = load_recorded_payloads(args.recorded) if args.recorded else None
+        ref_jsons = None
+        if not payloads:
+            ref_jsons = []
+            for path in glob(os.path.join(args.templates, "*_ref_ballot.json")):
+                with open(path, encoding="utf-8") as f:
+                    ref_jsons.append(json.load(f))
+        server_args = {"payloads": payloads, "ref_jsons": ref_jsons, "latency": args.latency,
+                       "rate_limit": args.rate_limit, "error_rate": args.error_rate}
+
+    if args.serve_only:
+        with FakeReadServer(port=args.port, **server_args) as server:
+            print(f"Fake Read endpoint: {server.endpoint}", flush=True)
+            try:
+                while True:
+                    time.sleep(60)
+            except KeyboardInterrupt:
+                print(json.dumps(server.counters))
+        return
+
+    if not args.images:
+        parser.error("--images is required unless --serve-only is given")
+    images = []
+    for path in sorted(glob(args.images)):
+        with open(path, "rb") as f:
+            images.append(f.read())
+    if not images:
+        parser.error(f"No images match '{args.images}'")
+
+    templates = load_templates(args.templates)
+    make_ocr = sdk_ocr if args.client == "sdk" else http_ocr
+
+    def load(endpoint):
+        return run_load(images, templates, make_ocr(endpoint), args.profile, args.concurrency, args.rate,
+                        args.duration, {"quality_check": not args.no_quality_check}, args.budget)
+
+    if args.endpoint:
+        report = load(args.endpoint)
+    else:
+        with FakeReadServerProcess(**server_args) as server:
+            report = load(server.endpoint)
+        report["fake_endpoint"] = server.counters
+
+    print(json.dumps({key: value for key, value in report.items() if key != "timeline"}, indent=4))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
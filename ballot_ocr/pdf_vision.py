@@ -10,6 +10,8 @@
 - `analyze_image`: Принимает путь к изображению на локальной машине и использует Azure's Computer Vision API
   для получения информации о содержимом изображения и извлечения текста.
 
+- `analyze_image_data`: То же, что `analyze_image`, но принимает байты изображения, уже находящегося в памяти.
+
 - `analyze_image_url`: Позволяет анализировать изображения, расположенные по URL-адресу (например, на Amazon S3).
   Может использовать как прямые URL-адреса изображений, так и потоки данных изображений.
 
@@ -25,8 +27,8 @@
 
 Конфигурационные параметры для подключения к Azure (такие как `endpoint` и `key`) предполагается устанавливать через внешний файл или переменные среды.
 
-Скрипт включает в себя заглушки для применения фильтров к изображениям (закомментировано),
-которые можно активировать для улучшения качества OCR.
+Для улучшения качества OCR страницы можно пропустить через цепочку фильтров из `image_filters`
+(параметр `filters` функции `analyze_images`); обработка выполняется в памяти, без временных файлов.
 
 Использование:
 
@@ -41,13 +43,14 @@
 import json
 
 import os
+import cv2
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.vision.imageanalysis import ImageAnalysisClient
 from azure.ai.vision.imageanalysis.models import VisualFeatures
 
 from azure_credentials import azure_endpoint, azure_key
-
-#from apply_image_filter import apply_filters
+from errors import ImageDecodeError
+from image_filters import preprocess_image, encode_image
 
 # Поместите эти значения из вашего ресурса Azure
 endpoint = azure_endpoint
@@ -70,14 +73,23 @@ handler.setFormatter(formatter)
 # Функция для анализа изображения с использованием Computer Vision API
 def analyze_image(image_path):
 
+    with open(image_path, "rb") as image_stream:
+        return analyze_image_data(image_stream.read())
+
+# Функция для анализа уже загруженного в память изображения (например, после предобработки фильтрами)
+# service_endpoint позволяет направить запросы на другой адрес, например на фиктивный сервис load_test.py
+def analyze_image_data(image_data, timeout=None, service_endpoint=None):
+
     # Создание клиента анализа изображений
-    client = ImageAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key), logging_enable=False)
+    client = ImageAnalysisClient(endpoint=service_endpoint or endpoint, credential=AzureKeyCredential(key),
+                                 logging_enable=False)
 
-    with open(image_path, "rb") as image_stream:
-        result = client.analyze(image_data=image_stream.read(), visual_features=[VisualFeatures.CAPTION, VisualFeatures.READ])
-        #result = client.analyze(image_data=image_stream.read(), visual_features=[VisualFeatures.READ])
-        #client.anal
-        return result.as_dict()
+    # timeout — остаток бюджета времени на бюллетень: ограничивает и ожидание ответа, и повторные попытки SDK
+    kwargs = {"read_timeout": timeout, "connection_timeout": timeout, "timeout": timeout} if timeout is not None else {}
+    result = client.analyze(image_data=image_data, visual_features=[VisualFeatures.CAPTION, VisualFeatures.READ],
+                            **kwargs)
+    #result = client.analyze(image_data=image_stream.read(), visual_features=[VisualFeatures.READ])
+    return result.as_dict()
 
 # Функция для анализа изображения с использованием Computer Vision API и Amazon S3
 def analyze_image_url(image_path=None, use_local_file=True, s3_url=None):
@@ -108,11 +120,17 @@ def analyze_image_url(image_path=None, use_local_file=True, s3_url=None):
         result = client.analyze(image_url=s3_url, visual_features=[VisualFeatures.READ])
         return result.as_dict()
 
-# Функция для анализа изображений
-def analyze_images(pages_paths, results_dir):
+# Функция для анализа изображений. Если задана цепочка фильтров, страницы обрабатываются в памяти перед OCR
+def analyze_images(pages_paths, results_dir, filters=None):
     for page_path in pages_paths:
         print(f"Analyzing: {page_path}")
-        result_json = analyze_image(page_path)
+        if filters:
+            page = cv2.imread(page_path)
+            if page is None:
+                raise ImageDecodeError(f"Could not read page image '{page_path}'.")
+            result_json = analyze_image_data(encode_image(preprocess_image(page, filters)))
+        else:
+            result_json = analyze_image(page_path)
         page_num = os.path.splitext(os.path.basename(page_path))[0]
         with open(os.path.join(results_dir, f'result_{page_num}.json'), 'w', encoding='utf-8') as f:
             json.dump(result_json, f, ensure_ascii=False, indent=4)
@@ -121,15 +139,25 @@ def analyze_images(pages_paths, results_dir):
 
 # Путь к PDF файлу или URL
 pdf_path = "КретоваЕН_нет_в_базе.pdf"  # Замените на путь к вашему PDF файлу
-def pdf_OCR(pdf_path):
+
+# Цепочка фильтров для плохо отсканированных PDF. Не применяется по умолчанию: она меняет изображение, отправляемое в OCR,
+# а auto_orient может повернуть страницу, и тогда координаты в results/*.json относятся к повёрнутой странице
+PDF_FILTERS = ["contrast", "sharpen", "black_white", "auto_orient"]
+
+def pdf_OCR(pdf_path, filters=None):
+    """
+    Разбивает PDF на страницы и распознаёт их.
+
+    :param pdf_path: Путь к PDF файлу.
+    :param filters: Цепочка фильтров из image_filters.FILTERS (например, PDF_FILTERS). По умолчанию страницы
+                    отправляются в OCR без изменений.
+    """
 
     temp_dir = "temp"
     results_dir = "results"
     os.makedirs(temp_dir, exist_ok=True)
     os.makedirs(results_dir, exist_ok=True)
 
-    filters = ["contrast", "sharpen", "black_white", "rotate_90"]
-
     # Разбиение PDF на страницы и их анализ
     if os.path.exists(pdf_path):
         # Получаем список всех файлов с расширением .png в директории
@@ -138,9 +166,7 @@ def pdf_OCR(pdf_path):
         ###print(pages_paths)
         #pages_paths = split_pdf(pdf_path, temp_dir)
         pages_paths = split_pdf_to_jpeg(pdf_path, temp_dir)
-        ###filtered_pages = preprocess_images(pages_paths, filters, 'filtered')
-        #analyze_images(filtered_pages, results_dir)
-        analyze_images(pages_paths, results_dir)
+        analyze_images(pages_paths, results_dir, filters)
         print("Analysis complete, results are in the 'results' directory.")
     else:
         print("PDF file does not exist.")
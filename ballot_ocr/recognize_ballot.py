@@ -5,15 +5,20 @@
 анализ наличия отметок в бюллетене и классификацию бюллетеня по действительности.
 Результатом выполнения является JSON-объект с детализацией отметок, информацией о действительности бюллетеня
 и точности соответствия выбранного шаблона.
+
+Само распознавание выполняет реентерабельная функция `recognizer.recognize`, работающая с данными в памяти.
+Этот скрипт отвечает за файловую часть: чтение изображения, шаблонов и сохранение результата OCR в ballots_jsons.
 """
 
+import json
 import os
-from glob import glob
 
-from analize_squares import read_rectangles, analyze_rectangles
-from ballot_vision import load_keywords_from_file, save_to_json
-from find_keywords import calculate_affine_matrix
-from pdf_vision import analyze_image, analyze_image_url
+from ballot_vision import save_to_json
+from deadline import Deadline
+from errors import DeadlineExceeded, ImageQualityError, NoTemplateMatchError
+from pdf_vision import analyze_image_data
+from recognizer import recognize
+from template_store import load_templates
 
 
 def get_json_filename(image_path, output_dir="ballots_jsons"):
@@ -36,82 +41,70 @@ def get_json_filename(image_path, output_dir="ballots_jsons"):
 
     return json_file_path
 
-def get_templates_info(templates_dir):
-    """Возвращает список словарей с информацией о шаблонах."""
-    templates_info = []
-    ref_ballots = glob(os.path.join(templates_dir, "*_ref_ballot.json"))
-    for ref_ballot_path in ref_ballots:
-        prefix = os.path.basename(ref_ballot_path).split('_ref_ballot.json')[0]
-        keywords_path = os.path.join(templates_dir, f"{prefix}_ref_ballot_words.json")
-        rectangles_path = os.path.join(templates_dir, f"{prefix}_ref_rectangles.json")
-        templates_info.append({
-            "prefix": prefix,
-            "keywords_path": keywords_path,
-            "ref_json_path": ref_ballot_path,
-            "rectangles_path": rectangles_path,
-        })
-    return templates_info
-
-def recognize_ballot(image_path, verbose_mode=False, azure_ocr=True):
+def saved_json_ocr(json_file):
+    """Возвращает функцию OCR, которая вместо вызова Azure читает ранее сохранённый результат из json_file."""
+    def ocr(image_data, timeout=None):
+        with open(json_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return ocr
+
+def recognize_ballot(image_path, verbose_mode=False, azure_ocr=True, quality_check=True, quality_config=None,
+                     ocr_filters=None, marks_filters=None, debug_writer=None, templates_dir="templates",
+                     save_ocr_json=True, budget_seconds=None):
     """
     Распознает и анализирует бюллетень, используя шаблоны из указанной директории.
+    Обёртка над recognizer.recognize, сохраняющая прежний формат результата.
 
     :param image_path: Путь к изображению бюллетеня для анализа.
     :param verbose_mode: Если True, печатает дополнительную информацию в процессе выполнения.
     :param azure_ocr: Если True, использует Azure Computer Vision для распознавания текста на изображении.
-    :return: JSON-объект с результатами анализа отметок, включая дополнительные поля 'invalid' и 'affinity_accuracy'.
+                      Если False, использует ранее сохранённый результат из ballots_jsons/<имя изображения>.json.
+    :param quality_check: Если True, перед OCR проверяет качество изображения и не отправляет в Azure негодные снимки.
+    :param quality_config: Настройки проверки качества (см. image_quality.DEFAULT_QUALITY_CONFIG).
+    :param ocr_filters: Цепочка фильтров из image_filters.FILTERS, применяемая к изображению перед OCR.
+    :param marks_filters: Цепочка фильтров, применяемая к изображению перед поиском отметок.
+    :param debug_writer: debug_artifacts.DebugArtifactWriter. Если задан, для выбранных им бюллетеней в фоне
+                         сохраняются вырезанные области с контурами и наложения шаблонов.
+    :param templates_dir: Директория шаблонов.
+    :param save_ocr_json: Если True, результат Azure OCR сохраняется в ballots_jsons/<имя изображения>.json.
+    :param budget_seconds: Бюджет времени на бюллетень в секундах (см. deadline.Deadline). None — без ограничения.
+    :return: JSON-объект с результатами анализа отметок, включая дополнительные поля 'invalid', 'affinity_accuracy',
+             'inlier_ratio', 'anchors', 'quality_flags', 'status' и 'degradations'. Если изображение отклонено проверкой качества, возвращается словарь с полями
+             'rejected' (код причины) и 'quality'. Если время истекло до выбора шаблона, возвращается словарь
+             с полями 'rejected' ('deadline_exceeded') и 'stage'. Если шаблон не подошёл, возвращается None.
     """
-    #image_path = "test_ballots/due_photo_2024-03-15_16-15-04.jpg"
-    #image_path = "test_ballots/new_ballot.jpg"
-    templates_dir = "templates"
-
-    templates_info = get_templates_info(templates_dir)
-
-    best_error = float('inf')
-    best_template_info = None
-    best_affine_matrix = None
-
-    for template_info in templates_info:
-        keywords = load_keywords_from_file(template_info["keywords_path"])
-        new_json_file = get_json_filename(image_path)
-        print(f"json file path: {new_json_file}")
-        #new_json_file = "ballots_jsons\\new_ballot.json"
-        #new_json_file = 'tatar_ballot.json'
-        #new_json_file = 'new_ballot.json'
-        if azure_ocr:
-            new_json_data = analyze_image(image_path)
-            #new_json_data = analyze_image_url(image_path)
-            save_to_json(new_json_data, new_json_file)
-        M, mean_error = calculate_affine_matrix(template_info["ref_json_path"], new_json_file, keywords)
-
-        if verbose_mode:
-            print(f"Template {template_info['prefix']}: Mean Error = {mean_error}")
-
-        if mean_error < best_error:
-            best_error = mean_error
-            best_template_info = template_info
-            best_affine_matrix = M
-
-    if best_template_info is not None:
-        rectangles = read_rectangles(best_template_info["rectangles_path"])
-        marks = analyze_rectangles(image_path, rectangles, best_affine_matrix, verbose_mode)
-
-        # Подсчет количества True значений в отметках
-        true_marks_count = sum(marks.values())
-
-        # Добавление поля invalid в зависимости от количества True значений
-        marks['invalid'] = true_marks_count != 1
-
-        # Добавление поля affinity_accuracy
-        marks['affinity_accuracy'] = best_error
-
-        print(f"Using Template {best_template_info['prefix']} with Mean Error = {best_error}")
-        #print(marks)
-        return marks
+    deadline = Deadline(budget_seconds) if budget_seconds is not None else None
+    templates = load_templates(templates_dir)
+    json_file = get_json_filename(image_path)
+
+    if azure_ocr:
+        ocr = analyze_image_data
+        on_ocr_result = (lambda data: save_to_json(data, json_file)) if save_ocr_json else None
     else:
-        print("Could not find a suitable template.")
+        ocr = saved_json_ocr(json_file)
+        on_ocr_result = None
+
+    with open(image_path, "rb") as f:
+        image_data = f.read()
+
+    try:
+        result = recognize(image_data, templates, ocr, quality_check=quality_check, quality_config=quality_config,
+                           ocr_filters=ocr_filters, marks_filters=marks_filters, on_ocr_result=on_ocr_result,
+                           debug_writer=debug_writer, verbose_mode=verbose_mode, name=image_path, deadline=deadline)
+    except ImageQualityError as e:
+        print(e)
+        return {"rejected": e.reason, "quality": e.quality}
+    except DeadlineExceeded as e:
+        print(e)
+        return {"rejected": "deadline_exceeded", "stage": e.stage}
+    except NoTemplateMatchError as e:
+        print(e)
         return None
 
+    print(f"Using Template {result.template} with Inlier Error = {result.affinity_accuracy} "
+          f"({result.inlier_ratio:.0%} inliers, {result.anchors} anchors)")
+    return result.to_dict()
+
 if __name__ == "__main__":
 
     # TODO: Сюда добавить кусок, скачивающий нужный файл из хранилища
@@ -131,6 +124,7 @@ if __name__ == "__main__":
     # Запускаем главную функцию распознавания бюллетеня. azure_ocr=True означает, что используется ресурс azure
     # Если azure_ocr = False, подразумевается, что есть результат распознавания в виде json и остается только распознать отметки
     marks = recognize_ballot(image_path, verbose_mode=False, azure_ocr=True)
-    # Ответ содержит json с 6-ю полями: 4 отметки, флаг недействительного бюллетеня,
-    # и точность подгонки аффинной матрицы (насколько нам подошел один из шаблонов бюллетеней)
+    # Ответ содержит json с полями: 4 отметки, флаг недействительного бюллетеня,
+    # точность подгонки аффинной матрицы по inliers, доля inliers и число опорных слов
+    # (насколько нам подошел один из шаблонов бюллетеней), замечания проверки качества изображения и статус обработки
     print(marks)
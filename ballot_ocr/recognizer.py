@@ -0,0 +1,308 @@
+"""
+Этот скрипт содержит реентерабельное API распознавания бюллетеня без побочных эффектов.
+
+Функция `recognize(image, templates, ocr)` получает все данные в памяти:
+- image: байты закодированного изображения или уже декодированный numpy массив;
+- templates: список шаблонов `Template`, загруженных заранее (например, через `template_store.load_templates`);
+- ocr: функция, принимающая байты изображения и возвращающая результат OCR в формате Azure ('readResult').
+
+Функция не читает и не пишет файлы, не зависит от текущей директории и не вызывает exit().
+Сохранение результата OCR подключается отдельно через необязательный обработчик `on_ocr_result`,
+а все ошибки выбрасываются как типизированные исключения из `errors`.
+Поэтому её можно одновременно вызывать из многих потоков или процессов.
+
+Необязательный бюджет времени (`deadline.Deadline`) передаётся через все этапы: вызов OCR получает остаток времени
+как таймаут, перебор шаблонов и анализ отметок прерываются при его исчерпании, а результат получает код `status`.
+
+Функция `recognize_many` распознаёт пакет бюллетеней и классифицирует отметки пакетно по шаблонам (см. `batch_marks`).
+"""
+
+
+from dataclasses import dataclass, field
+
+import cv2
+import numpy as np
+
+from analize_squares import analyze_rectangles
+from batch_marks import classify_template_marks
+from deadline import STATUS_BEST_TEMPLATE_SO_FAR, STATUS_MARKS_UNDETERMINED, STATUS_OK, Deadline
+from errors import (AlignmentError, BallotRecognitionError, DeadlineExceeded, ImageDecodeError, ImageQualityError,
+                    NoTemplateMatchError, OCRError)
+from find_keywords import anchor_points, extract_words_with_coordinates, score_alignment
+from fuzzy_match import get_index
+from image_filters import check_geometry_compatible, encode_image, preprocess_image
+from image_quality import check_image_quality
+
+
+@dataclass
+class RecognitionResult:
+    """Результат распознавания бюллетеня."""
+    marks: dict
+    invalid: bool
+    affinity_accuracy: float    # средняя ошибка подгонки шаблона по inliers, в пикселях
+    template: str
+    quality_flags: list = field(default_factory=list)
+    status: str = STATUS_OK     # первое ограничение по времени, см. deadline.py
+    inlier_ratio: float = 1.0
+    anchors: int = 0
+    degradations: list = field(default_factory=list)    # все ограничения по времени, в порядке этапов
+
+    def to_dict(self):
+        """
+        Возвращает результат в прежнем формате recognize_ballot:
+        отметки, 'invalid', 'affinity_accuracy', 'inlier_ratio', 'anchors', 'quality_flags', 'status' и 'degradations'.
+        """
+        result = dict(self.marks)
+        result["invalid"] = self.invalid
+        result["affinity_accuracy"] = self.affinity_accuracy
+        result["inlier_ratio"] = self.inlier_ratio
+        result["anchors"] = self.anchors
+        result["quality_flags"] = self.quality_flags
+        result["status"] = self.status
+        result["degradations"] = list(self.degradations)
+        return result
+
+
+def decode_image(image):
+    """
+    Приводит входное изображение к паре (байты, декодированный массив).
+
+    :param image: Байты закодированного изображения или numpy массив.
+    :raises ImageDecodeError: Если изображение не удалось декодировать.
+    """
+    if isinstance(image, np.ndarray):
+        if image.size == 0:
+            raise ImageDecodeError("Empty image array.")
+        return None, image
+    data = bytes(image)
+    decoded = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if decoded is None:
+        raise ImageDecodeError("Could not decode image data.")
+    return data, decoded
+
+
+@dataclass
+class _Alignment:
+    """Промежуточное состояние распознавания после выбора шаблона."""
+    marks_image: np.ndarray
+    template: object
+    score: object           # find_keywords.AlignmentScore
+    quality_flags: list
+    alignments: list
+    status: str = STATUS_OK
+
+
+def _call_ocr(ocr, ocr_input, deadline):
+    """Вызывает OCR, передавая остаток бюджета времени как таймаут запроса."""
+    if deadline is None:
+        return ocr(ocr_input)
+    deadline.check("ocr")
+    result = ocr(ocr_input, timeout=deadline.remaining())
+    # Функция OCR могла не соблюсти таймаут
+    deadline.check("ocr")
+    return result
+
+
+def _align(image, templates, ocr, quality_check, quality_config, ocr_filters, marks_filters, on_ocr_result,
+           debug_writer, verbose_mode, name, fuzzy, deadline=None):
+    """Выполняет проверку качества, OCR и выбор шаблона. Общая часть recognize и recognize_many."""
+    check_geometry_compatible(ocr_filters, marks_filters)
+    data, decoded = decode_image(image)
+
+    quality_flags = []
+    if quality_check:
+        # Быстрая локальная проверка до платного вызова OCR
+        quality = check_image_quality(data if data is not None else decoded, quality_config)
+        if verbose_mode:
+            print(f"Image quality: {quality}")
+        if not quality["passed"]:
+            raise ImageQualityError(quality["reason"], quality)
+        quality_flags = quality["flags"]
+
+    # Промежуточные результаты фильтров нужны только для этого бюллетеня
+    filter_memo = {}
+
+    # OCR выполняется один раз для всех шаблонов
+    if ocr_filters:
+        ocr_input = encode_image(preprocess_image(decoded, ocr_filters, filter_memo))
+    elif data is not None:
+        ocr_input = data
+    else:
+        ocr_input = encode_image(decoded)
+    try:
+        ocr_result = _call_ocr(ocr, ocr_input, deadline)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        raise OCRError(f"OCR failed: {e}") from e
+    if on_ocr_result is not None:
+        on_ocr_result(ocr_result)
+
+    # Опорные слова ищутся для всех шаблонов заранее, и первыми проверяются шаблоны с наибольшим числом опорных слов:
+    # тогда сильный кандидат находится раньше, а шаблоны, которые не могут его превзойти, отсекаются без RANSAC
+    candidates = []
+    for template in templates:
+        matcher = (template.matcher or get_index(template.keywords)) if fuzzy else None
+        points = anchor_points(extract_words_with_coordinates(ocr_result, template.keywords, matcher))
+        candidates.append((len(points.keys() & template.ref_words.keys()), template, points))
+    candidates.sort(key=lambda candidate: -candidate[0])
+
+    best = None
+    best_template = None
+    alignments = []
+    status = STATUS_OK
+
+    for _, template, points in candidates:
+        if deadline is not None and deadline.expired():
+            if best_template is None:
+                raise DeadlineExceeded("templates")
+            # Время вышло: используем лучший из уже проверенных шаблонов
+            status = STATUS_BEST_TEMPLATE_SO_FAR
+            break
+        try:
+            score = score_alignment(template.ref_words, points, best)
+        except AlignmentError as e:
+            if verbose_mode:
+                print(f"Template {template.prefix}: {e}")
+            continue
+
+        if verbose_mode:
+            print(f"Template {template.prefix}: {score.inliers} inliers ({score.inlier_ratio:.0%}) "
+                  f"from {score.anchors} anchors, Inlier Error = {score.inlier_error}")
+        if debug_writer is not None:
+            alignments.append({"template": template.prefix, "matrix": score.matrix, "error": score.inlier_error,
+                               "rectangles": template.rectangles})
+
+        if score.beats(best):
+            best = score
+            best_template = template
+
+    marks_image = preprocess_image(decoded, marks_filters, filter_memo)
+
+    if best_template is None:
+        if debug_writer is not None and debug_writer.should_sample(None):
+            debug_writer.submit(name or "ballot", marks_image, None, None, alignments)
+        raise NoTemplateMatchError("Could not find a suitable template.")
+
+    return _Alignment(marks_image, best_template, best, quality_flags, alignments, status)
+
+
+def _make_result(aligned, marks, debug_writer, rectangles_debug, name):
+    """Формирует RecognitionResult и при необходимости передаёт артефакты отладочному писателю."""
+    # Ограничения этапов накапливаются: прерванный перебор шаблонов не должен теряться из-за неопределённых отметок
+    degradations = [aligned.status] if aligned.status != STATUS_OK else []
+    checked = sum(1 for value in marks.values() if value)
+    if any(value is None for value in marks.values()):
+        # Часть отметок не проанализирована: бюллетень точно недействителен только при двух и более отметках
+        degradations.append(STATUS_MARKS_UNDETERMINED)
+        invalid = True if checked > 1 else None
+    else:
+        # Бюллетень действителен, только если отмечен ровно один вариант
+        invalid = checked != 1
+
+    result = RecognitionResult(
+        marks=marks,
+        invalid=invalid,
+        affinity_accuracy=aligned.score.inlier_error,
+        template=aligned.template.prefix,
+        quality_flags=aligned.quality_flags,
+        status=degradations[0] if degradations else STATUS_OK,
+        inlier_ratio=aligned.score.inlier_ratio,
+        anchors=aligned.score.anchors,
+        degradations=degradations,
+    )
+
+    if debug_writer is not None:
+        legacy = result.to_dict()
+        if debug_writer.should_sample(legacy):
+            debug_writer.submit(name or "ballot", aligned.marks_image, legacy, rectangles_debug, aligned.alignments)
+
+    return result
+
+
+def recognize(image, templates, ocr, quality_check=True, quality_config=None, ocr_filters=None, marks_filters=None,
+              on_ocr_result=None, debug_writer=None, verbose_mode=False, name=None, fuzzy=True, deadline=None):
+    """
+    Распознает бюллетень без обращения к файловой системе.
+
+    :param image: Байты закодированного изображения или декодированное изображение (numpy массив BGR).
+    :param templates: Последовательность объектов Template.
+    :param ocr: Функция ocr(image_bytes) -> dict с результатом OCR в формате Azure ('readResult').
+    :param quality_check: Если True, перед OCR проверяет качество изображения.
+    :param quality_config: Настройки проверки качества (см. image_quality.DEFAULT_QUALITY_CONFIG).
+    :param ocr_filters: Цепочка фильтров из image_filters.FILTERS для ветки OCR.
+    :param marks_filters: Цепочка фильтров для ветки поиска отметок.
+    :param on_ocr_result: Необязательный обработчик, которому передаётся результат OCR (например, для сохранения).
+    :param debug_writer: debug_artifacts.DebugArtifactWriter для сохранения отладочных артефактов.
+    :param verbose_mode: Если True, печатает дополнительную информацию.
+    :param name: Имя бюллетеня для сообщений и отладочных артефактов.
+    :param fuzzy: Если True, ключевые слова в результате OCR ищутся нечётко (по индексу триграмм шаблона).
+    :param deadline: deadline.Deadline — бюджет времени на бюллетень. Функция ocr тогда вызывается как
+                     ocr(image_bytes, timeout=секунды), а при исчерпании времени возвращается частичный результат
+                     со статусом best_template_so_far и/или marks_undetermined (см. RecognitionResult.degradations).
+    :return: RecognitionResult.
+    :raises ImageDecodeError: Изображение не удалось декодировать.
+    :raises ImageQualityError: Изображение отклонено проверкой качества.
+    :raises OCRError: Ошибка сервиса OCR.
+    :raises NoTemplateMatchError: Ни один шаблон не подошёл.
+    :raises DeadlineExceeded: Время истекло до получения OCR или до первого подошедшего шаблона.
+    """
+    aligned = _align(image, templates, ocr, quality_check, quality_config, ocr_filters, marks_filters, on_ocr_result,
+                     debug_writer, verbose_mode, name, fuzzy, deadline)
+
+    rectangles_debug = [] if debug_writer is not None else None
+    marks = analyze_rectangles(aligned.marks_image, aligned.template.rectangles, aligned.score.matrix, verbose_mode,
+                               rectangles_debug, deadline)
+    return _make_result(aligned, marks, debug_writer, rectangles_debug, name)
+
+
+def recognize_many(images, templates, ocr, names=None, batch_params=None, verify_batch=True, budget_seconds=None,
+                   **kwargs):
+    """
+    Распознает пакет бюллетеней. Выбор шаблона выполняется для каждого бюллетеня отдельно,
+    а отметки классифицируются пакетно (batch_marks.classify_marks_batch) для всех бюллетеней одного шаблона.
+    При первом пакете шаблона batch_marks.classify_template_marks сравнивает пакетный классификатор с analyze_rectangles
+    на первых бюллетенях; если он не прошёл проверку, отметки шаблона анализируются по одной.
+
+    :param images: Список изображений (байты или numpy массивы).
+    :param templates: Последовательность объектов Template.
+    :param ocr: Функция OCR.
+    :param names: Имена бюллетеней (для сообщений и отладочных артефактов).
+    :param batch_params: Параметры batch_marks.classify_stack.
+    :param verify_batch: Если False, пакетный классификатор используется без сравнения с analyze_rectangles.
+    :param budget_seconds: Бюджет времени на каждый бюллетень в секундах. Для каждого бюллетеня создаётся свой
+                           deadline.Deadline, когда начинается его обработка; отметки бюллетеня, время которого
+                           истекло к моменту классификации, получают значение None.
+    :param kwargs: Остальные параметры recognize (кроме on_ocr_result, который вызывается для каждого бюллетеня,
+                   и deadline, который заменяет budget_seconds).
+    :return: Список той же длины, что images: RecognitionResult или исключение BallotRecognitionError для бюллетеня.
+    """
+    if "deadline" in kwargs:
+        raise TypeError("recognize_many takes budget_seconds (a budget per ballot) instead of a shared deadline")
+    names = names or [None] * len(images)
+    debug_writer = kwargs.get("debug_writer")
+
+    results = [None] * len(images)
+    groups = {}
+    for i, (image, name) in enumerate(zip(images, names)):
+        deadline = Deadline(budget_seconds) if budget_seconds is not None else None
+        try:
+            aligned = _align(image, templates, ocr, kwargs.get("quality_check", True), kwargs.get("quality_config"),
+                             kwargs.get("ocr_filters"), kwargs.get("marks_filters"), kwargs.get("on_ocr_result"),
+                             debug_writer, kwargs.get("verbose_mode", False), name, kwargs.get("fuzzy", True),
+                             deadline)
+        except BallotRecognitionError as e:
+            results[i] = e
+            continue
+        groups.setdefault(aligned.template.prefix, []).append((i, aligned, deadline))
+
+    for prefix, members in groups.items():
+        batch = classify_template_marks(prefix, [aligned.marks_image for _, aligned, _ in members],
+                                        [aligned.score.matrix for _, aligned, _ in members],
+                                        members[0][1].template.rectangles, verify_batch,
+                                        verbose_mode=kwargs.get("verbose_mode", False),
+                                        deadlines=[deadline for _, _, deadline in members], **(batch_params or {}))
+        for (i, aligned, _), marks in zip(members, batch):
+            results[i] = _make_result(aligned, marks, debug_writer, [], names[i])
+
+    return results
@@ -0,0 +1,387 @@
+"""
+Этот скрипт отвечает за загрузку шаблонов бюллетеней и за их скомпилированное хранилище.
+
+Исходные шаблоны лежат в директории templates/ отдельными JSON файлами
+(`*_ref_ballot.json`, `*_ref_ballot_words.json`, `*_ref_rectangles.json`). Разбирать их в каждом процессе
+дорого: эталонный результат OCR большой, а нужны из него только координаты ключевых слов.
+
+`compile_templates` собирает все шаблоны в один двоичный файл (по умолчанию templates/templates.bin):
+
+    заголовок | строки UTF-8 | оглавление шаблонов | таблица ключевых слов | многоугольники слов | прямоугольники отметок
+
+Все таблицы — массивы фиксированной структуры, выровненные по 64 байта. `TemplateStore` отображает файл в память
+только для чтения (mmap) и создаёт numpy представления поверх него без копирования, поэтому все процессы на машине
+используют одну копию данных в страничном кеше ОС, а запуск обработчика не требует разбора JSON.
+
+Новая версия файла записывается во временный файл и атомарно подменяет старую (os.replace).
+`TemplateStore.refresh` замечает подмену и переотображает файл; уже выданные шаблоны продолжают ссылаться
+на старое отображение, пока используются, поэтому обработчик видит либо старую, либо новую версию целиком.
+"""
+
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from glob import glob
+
+import numpy as np
+
+from errors import TemplateError
+from find_keywords import extract_words_with_coordinates
+from fuzzy_match import get_index
+
+STORE_FILE_NAME = "templates.bin"
+
+STORE_MAGIC = b"BTPL"
+STORE_FORMAT = 1
+ALIGNMENT = 64
+
+# magic, формат, версия содержимого, число шаблонов, затем (смещение, количество элементов) для каждой секции
+HEADER = struct.Struct("<4sIQI4x" + "QQ" * 5)
+
+TOC_DTYPE = np.dtype([("prefix_offset", "<u4"), ("prefix_length", "<u4"),
+                      ("keywords_start", "<u4"), ("keywords_count", "<u4"),
+                      ("rectangles_start", "<u4"), ("rectangles_count", "<u4")])
+KEYWORD_DTYPE = np.dtype([("offset", "<u4"), ("length", "<u4"), ("polygon", "<i4")])
+
+
+@dataclass(frozen=True)
+class Template:
+    """
+    Шаблон бюллетеня, полностью загруженный в память.
+
+    :param prefix: Имя шаблона (префикс файлов в директории шаблонов).
+    :param keywords: Ключевые слова, по которым ищется аффинное преобразование.
+    :param ref_words: Точки ключевых слов на эталонном бюллетене {слово: массив 4x2 float32}.
+    :param rectangles: Прямоугольники отметок [x1, y1, x2, y2] в координатах эталонного бюллетеня.
+    :param matcher: Индекс триграмм ключевых слов для нечёткого сопоставления (fuzzy_match.TrigramIndex).
+    """
+    prefix: str
+    keywords: tuple
+    ref_words: dict = field(compare=False)
+    rectangles: object = field(compare=False)
+    matcher: object = field(default=None, compare=False)
+
+
+def get_templates_info(templates_dir):
+    """Возвращает список словарей с информацией о шаблонах."""
+    templates_info = []
+    ref_ballots = glob(os.path.join(templates_dir, "*_ref_ballot.json"))
+    for ref_ballot_path in ref_ballots:
+        prefix = os.path.basename(ref_ballot_path).split('_ref_ballot.json')[0]
+        keywords_path = os.path.join(templates_dir, f"{prefix}_ref_ballot_words.json")
+        rectangles_path = os.path.join(templates_dir, f"{prefix}_ref_rectangles.json")
+        templates_info.append({
+            "prefix": prefix,
+            "keywords_path": keywords_path,
+            "ref_json_path": ref_ballot_path,
+            "rectangles_path": rectangles_path,
+        })
+    return templates_info
+
+
+def _load_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise TemplateError(f"Could not load template file '{path}': {e}") from e
+
+
+def load_template(template_info):
+    """
+    Загружает шаблон из JSON файлов по словарю из get_templates_info.
+    Из эталонного результата OCR сохраняются только координаты ключевых слов, сразу в виде массивов точек,
+    чтобы при оценке подгонки (find_keywords.score_alignment) их не нужно было преобразовывать заново.
+
+    :raises TemplateError: Если файлы шаблона отсутствуют или повреждены.
+    """
+    keywords = _load_json(template_info["keywords_path"])
+    ref_json = _load_json(template_info["ref_json_path"])
+    rectangles = _load_json(template_info["rectangles_path"])
+    ref_words = {}
+    for word, polygon in extract_words_with_coordinates(ref_json, keywords).items():
+        points = _polygon_array(polygon)
+        if points is not None:
+            ref_words[word] = points
+    return Template(
+        prefix=template_info["prefix"],
+        keywords=tuple(keywords),
+        ref_words=ref_words,
+        rectangles=tuple(tuple(rectangle) for rectangle in rectangles),
+        matcher=get_index(keywords),
+    )
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _polygon_array(polygon):
+    """Преобразует boundingPolygon Azure в массив 4x2. Многоугольники другой формы не поддерживаются."""
+    if isinstance(polygon, np.ndarray):
+        points = polygon.astype(np.float32, copy=False)
+    else:
+        points = np.float32([(point['x'], point['y']) for point in polygon])
+    if points.shape != (4, 2):
+        return None
+    return points
+
+
+def compile_templates(templates_dir, output_path=None):
+    """
+    Собирает все шаблоны директории в один файл хранилища и атомарно заменяет им предыдущую версию.
+
+    :param templates_dir: Директория с JSON файлами шаблонов.
+    :param output_path: Путь к файлу хранилища; по умолчанию <templates_dir>/templates.bin.
+    :return: Версия содержимого (целое число).
+    """
+    output_path = output_path or os.path.join(templates_dir, STORE_FILE_NAME)
+    templates = [load_template(info) for info in sorted(get_templates_info(templates_dir), key=lambda t: t["prefix"])]
+
+    strings = bytearray()
+
+    def add_string(text):
+        data = text.encode("utf-8")
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    toc_rows, keyword_rows, polygons, rectangles = [], [], [], []
+    for template in templates:
+        toc_rows.append((*add_string(template.prefix), len(keyword_rows), len(template.keywords),
+                         len(rectangles), len(template.rectangles)))
+        for keyword in template.keywords:
+            offset, length = add_string(keyword)
+            polygon = template.ref_words.get(keyword.lower())
+            points = _polygon_array(polygon) if polygon is not None else None
+            if points is None:
+                keyword_rows.append((offset, length, -1))
+            else:
+                keyword_rows.append((offset, length, len(polygons)))
+                polygons.append(points)
+        rectangles.extend(template.rectangles)
+
+    sections = [
+        np.frombuffer(bytes(strings), dtype=np.uint8),
+        np.array(toc_rows, dtype=TOC_DTYPE),
+        np.array(keyword_rows, dtype=KEYWORD_DTYPE),
+        np.array(polygons, dtype=np.float32).reshape(-1, 4, 2),
+        np.array(rectangles, dtype=np.float32).reshape(-1, 4),
+    ]
+
+    # Версия — хеш содержимого, чтобы одинаковые шаблоны давали одинаковую версию на всех узлах
+    digest = hashlib.blake2b(digest_size=8)
+    for section in sections:
+        digest.update(np.ascontiguousarray(section).tobytes())
+    version = int.from_bytes(digest.digest(), "little")
+
+    offset = _align(HEADER.size)
+    layout = []
+    for section in sections:
+        layout.extend([offset, section.size])
+        offset = _align(offset + section.nbytes)
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(STORE_MAGIC, STORE_FORMAT, version, len(templates), *layout))
+        for section, section_offset in zip(sections, layout[::2]):
+            f.seek(section_offset)
+            f.write(np.ascontiguousarray(section).tobytes())
+        f.truncate(offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path)
+    return version
+
+
+class _MappedStore:
+    """Одна отображённая в память версия файла хранилища."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        magic, file_format, self.version, self.count, *layout = HEADER.unpack_from(self.buffer, 0)
+        if magic != STORE_MAGIC or file_format != STORE_FORMAT:
+            raise TemplateError(f"'{path}' is not a template store of format {STORE_FORMAT}")
+
+        def view(index, dtype):
+            offset, count = layout[2 * index], layout[2 * index + 1]
+            return np.frombuffer(self.buffer, dtype=dtype, count=count, offset=offset)
+
+        self.strings = view(0, np.uint8)
+        self.toc = view(1, TOC_DTYPE)
+        self.keywords = view(2, KEYWORD_DTYPE)
+        self.polygons = view(3, np.float32).reshape(-1, 4, 2)
+        self.rectangles = view(4, np.float32).reshape(-1, 4)
+        self._templates = None
+
+    def string(self, offset, length):
+        return bytes(self.strings[offset:offset + length]).decode("utf-8")
+
+    def templates(self):
+        """Создаёт объекты Template, ссылающиеся на отображённые массивы без копирования."""
+        if self._templates is None:
+            templates = []
+            for entry in self.toc:
+                rows = self.keywords[entry["keywords_start"]:entry["keywords_start"] + entry["keywords_count"]]
+                keywords = tuple(self.string(row["offset"], row["length"]) for row in rows)
+                ref_words = {keyword.lower(): self.polygons[row["polygon"]]
+                             for keyword, row in zip(keywords, rows) if row["polygon"] >= 0}
+                start = entry["rectangles_start"]
+                templates.append(Template(
+                    prefix=self.string(entry["prefix_offset"], entry["prefix_length"]),
+                    keywords=keywords,
+                    ref_words=ref_words,
+                    rectangles=self.rectangles[start:start + entry["rectangles_count"]],
+                    matcher=get_index(keywords),
+                ))
+            self._templates = tuple(templates)
+        return self._templates
+
+
+class TemplateStore:
+    """
+    Доступ к скомпилированному хранилищу шаблонов только для чтения.
+    Потокобезопасен; refresh() переключается на новую версию файла, если он был атомарно заменён.
+    """
+
+    def __init__(self, path, check_interval=5.0):
+        """
+        :param path: Путь к файлу хранилища.
+        :param check_interval: Как часто (в секундах) templates() проверяет, не появилась ли новая версия.
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._current = _MappedStore(path)
+        self._checked = time.monotonic()
+
+    @property
+    def version(self):
+        return self._current.version
+
+    def refresh(self):
+        """
+        Переотображает файл, если он был заменён новой версией.
+
+        :return: True, если версия сменилась.
+        """
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return False
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == self._current.identity:
+                return False
+            mapped = _MappedStore(self.path)
+            changed = mapped.version != self._current.version
+            # Старое отображение освобождается, когда на его массивы не останется ссылок
+            self._current = mapped
+            return changed
+
+    def templates(self):
+        """Возвращает кортеж шаблонов текущей версии, при необходимости проверив наличие новой."""
+        if time.monotonic() - self._checked > self.check_interval:
+            self.refresh()
+        return self._current.templates()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path):
+    """Возвращает общий для процесса TemplateStore для файла path."""
+    path = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = TemplateStore(path)
+        return store
+
+
+# Шаблоны, загруженные из JSON: директория -> (набор префиксов, время изменения самого свежего файла, шаблоны).
+# На директорию хранится одна версия, поэтому устаревшие наборы не накапливаются
+_json_templates = {}
+_json_templates_lock = threading.Lock()
+
+
+def _load_templates_cached(templates_dir, templates_info, sources_mtime):
+    """
+    Загружает шаблоны из JSON или возвращает уже загруженные, если набор шаблонов и время изменения файлов не менялись.
+    Набор префиксов входит в ключ: удалённый шаблон или добавленный с более старым временем изменения
+    не меняет самое свежее время, но меняет набор.
+    """
+    key = (frozenset(info["prefix"] for info in templates_info), sources_mtime)
+    with _json_templates_lock:
+        cached = _json_templates.get(templates_dir)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    templates = tuple(load_template(info) for info in templates_info)
+    with _json_templates_lock:
+        _json_templates[templates_dir] = (key, templates)
+    return templates
+
+
+def _sources_mtime(templates_info):
+    """Время изменения самого свежего JSON файла шаблонов (в наносекундах)."""
+    newest = 0
+    for info in templates_info:
+        for key in ("keywords_path", "ref_json_path", "rectangles_path"):
+            try:
+                newest = max(newest, os.stat(info[key]).st_mtime_ns)
+            except FileNotFoundError:
+                continue
+    return newest
+
+
+_stale_warned = set()
+
+
+def load_templates(templates_dir):
+    """
+    Загружает все шаблоны из директории. Если в ней есть скомпилированное хранилище templates.bin,
+    шаблоны берутся из него (отображение в память, без разбора JSON); иначе JSON файлы разбираются один раз
+    и результат кешируется, пока файлы не изменятся.
+
+    Если какой-либо JSON файл шаблона новее хранилища или набор шаблонов в нём не совпадает с JSON файлами
+    (хранилище забыли пересобрать после правки), выводится предупреждение и шаблоны загружаются из JSON.
+
+    :param templates_dir: Директория шаблонов.
+    :return: Кортеж объектов Template.
+    """
+    templates_dir = os.path.abspath(templates_dir)
+    store_path = os.path.join(templates_dir, STORE_FILE_NAME)
+    templates_info = get_templates_info(templates_dir)
+    sources_mtime = _sources_mtime(templates_info)
+    if os.path.exists(store_path):
+        templates = get_store(store_path).templates()
+        store_mtime = os.stat(store_path).st_mtime_ns
+        prefixes = {info["prefix"] for info in templates_info}
+        if sources_mtime <= store_mtime and {template.prefix for template in templates} == prefixes:
+            return templates
+        if (store_path, store_mtime) not in _stale_warned:
+            _stale_warned.add((store_path, store_mtime))
+            print(f"Warning: {store_path} does not match the template JSON files, loading templates from JSON. "
+                  f"Recompile it with: python template_store.py {templates_dir}")
+    return _load_templates_cached(templates_dir, templates_info, sources_mtime)
+
+
+if __name__ == "__main__":
+    import sys
+
+    templates_dir = sys.argv[1] if len(sys.argv) > 1 else "templates"
+    output_path = sys.argv[2] if len(sys.argv) > 2 else None
+    version = compile_templates(templates_dir, output_path)
+    store = TemplateStore(output_path or os.path.join(templates_dir, STORE_FILE_NAME))
+    print(f"Compiled {len(store.templates())} templates, version {version:016x}")
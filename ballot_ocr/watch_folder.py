@@ -0,0 +1,441 @@
+"""
+Этот скрипт запускает демон приёма бюллетеней из директорий, в которые сканирующие станции складывают снимки.
+
+Использование:
+
+    python watch_folder.py --results results.jsonl --workers 4 /shared/station1 /shared/station2
+
+Как это работает:
+
+1. Директории отслеживаются через inotify (Linux, через ctypes). Если inotify недоступен или директория находится
+   на сетевой файловой системе, где события с других машин не приходят (--poll), директории периодически сканируются.
+   Даже с inotify раз в --rescan секунд выполняется полное сканирование, чтобы не потерять события
+   при переполнении очереди ядра.
+2. Файл считается записанным полностью, если после закрытия на запись (IN_CLOSE_WRITE) или в течение --settle секунд
+   его размер и время изменения не менялись и у JPEG/PNG на месте маркер конца файла.
+3. Готовые файлы передаются на распознавание (ballot_worker.recognize_job) не более чем --workers одновременно;
+   остальные ждут в порядке поступления. Содержимое хешируется (ballot_worker.make_job_id), и повторно
+   подброшенный тот же снимок не распознаётся второй раз, если первая попытка завершилась результатом
+   (после ошибки или исчерпания бюджета времени его можно подбросить снова).
+4. Результаты пишутся в журнал JSONL строго в порядке поступления файлов, даже если распознавание
+   завершается в другом порядке. При перезапуске журнал читается заново: уже обработанные файлы и хеши
+   не обрабатываются повторно.
+"""
+
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import signal
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ballot_worker import make_job_id, recognize_job
+from json_utils import json_default
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+
+# Константы inotify из <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    """Наблюдатель без событий: новые файлы находит только периодическое сканирование директорий."""
+
+    needs_polling = True
+    overflowed = False
+
+    def __init__(self, directories):
+        self.directories = directories
+
+    def poll(self, timeout, wake_fd=None):
+        if wake_fd is None:
+            time.sleep(timeout)
+        else:
+            select.select([wake_fd], [], [], timeout)
+        return []
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Наблюдатель на inotify: сообщает о файлах, закрытых после записи или перемещённых в директорию."""
+
+    needs_polling = False
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, f"inotify_add_watch failed for {directory}")
+            self.directories[wd] = directory
+        self.overflowed = False
+
+    def poll(self, timeout, wake_fd=None):
+        """
+        Ждёт события не дольше timeout секунд.
+
+        :param wake_fd: Дополнительный дескриптор, готовность которого прерывает ожидание.
+        :return: Список пар (путь, закрыт_после_записи). При переполнении очереди ядра выставляет self.overflowed.
+        """
+        readable, _, _ = select.select([self.fd] + ([wake_fd] if wake_fd is not None else []), [], [], timeout)
+        if self.fd not in readable:
+            return []
+        try:
+            buffer = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif name and wd in self.directories:
+                events.append((os.path.join(self.directories[wd], os.fsdecode(name)), bool(mask & IN_CLOSE_WRITE)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(directories, use_inotify=True):
+    """Возвращает InotifyWatcher, а если inotify недоступен — PollingWatcher."""
+    if use_inotify:
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError) as e:
+            print(f"inotify is not available ({e}), falling back to polling")
+    return PollingWatcher(directories)
+
+
+def is_image_file(path, extensions=IMAGE_EXTENSIONS):
+    """Проверяет расширение и отбрасывает временные файлы, которые сканеры пишут перед переименованием."""
+    name = os.path.basename(path)
+    return not name.startswith(".") and name.lower().endswith(extensions)
+
+
+def has_end_marker(path):
+    """
+    Проверяет, что JPEG заканчивается маркером EOI, а PNG — блоком IEND.
+    Для остальных форматов дешёвой проверки нет, и возвращается True.
+    """
+    lower = path.lower()
+    if not lower.endswith((".jpg", ".jpeg", ".png")):
+        return True
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 64))
+            tail = f.read().rstrip(b"\0")
+    except OSError:
+        return False
+    if lower.endswith(".png"):
+        return b"IEND" in tail[-12:]
+    return tail.endswith(b"\xff\xd9")
+
+
+class _Candidate:
+    """Файл, который ещё может дописываться."""
+
+    def __init__(self, stat, now):
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.stable_since = now
+        self.arrived_at = now
+        self.closed = False
+
+
+class OrderedResultsLog:
+    """
+    Журнал результатов в формате JSONL. Записи получают номера в порядке поступления файлов
+    и пишутся строго по возрастанию номера; завершившиеся раньше ждут в буфере.
+    Размер буфера ограничивает IngestDaemon: он не выдаёт новые номера, пока незаписанных записей
+    (выданных номеров, не дошедших до файла) больше max_unflushed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        self.records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Последняя строка могла оборваться при аварийной остановке
+                        continue
+        self.next_seq = max((record["seq"] for record in self.records), default=0) + 1
+        self._next_write = self.next_seq
+        self._buffer = {}
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def reserve(self):
+        """Выдаёт следующий номер записи."""
+        with self._lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            return seq
+
+    def unflushed(self):
+        """Количество выданных номеров, записи которых ещё не попали в файл (обрабатываются или ждут в буфере)."""
+        with self._lock:
+            return self.next_seq - self._next_write
+
+    def complete(self, seq, record):
+        """Принимает запись с номером seq и пишет все записи, до которых дошла очередь."""
+        with self._lock:
+            self._buffer[seq] = dict(record, seq=seq)
+            while self._next_write in self._buffer:
+                line = json.dumps(self._buffer.pop(self._next_write), ensure_ascii=False, default=json_default)
+                self._file.write(line + "\n")
+                self._next_write += 1
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _is_final(record):
+    """
+    True для записи с окончательным результатом распознавания. Ошибки (например, недоступность OCR)
+    и исчерпанный бюджет времени окончательными не считаются: такой снимок можно подбросить снова.
+    """
+    if not record.get("sha256") or "duplicate_of" in record or "error" in record:
+        return False
+    result = record.get("result")
+    return not (isinstance(result, dict) and result.get("rejected") == "deadline_exceeded")
+
+
+class IngestDaemon:
+    """Демон, передающий новые снимки из директорий на распознавание."""
+
+    def __init__(self, directories, results_log, handler=recognize_job, options=None, workers=4, settle_seconds=2.0,
+                 poll_interval=1.0, rescan_interval=60.0, incomplete_timeout=60.0, max_unflushed=256, use_inotify=True,
+                 extensions=IMAGE_EXTENSIONS):
+        """
+        :param directories: Директории, в которые сканеры складывают снимки.
+        :param results_log: Путь к журналу результатов JSONL.
+        :param handler: Функция, принимающая payload {'image_path', 'options'} (как в ballot_worker) и возвращающая результат.
+        :param options: Дополнительные параметры recognize_ballot.
+        :param workers: Максимальное количество одновременно распознаваемых файлов.
+        :param settle_seconds: Сколько секунд размер файла должен не меняться, чтобы считать запись законченной.
+        :param poll_interval: Период сканирования без inotify и период проверки дописываемых файлов.
+        :param rescan_interval: Период полного сканирования при работе через inotify.
+        :param incomplete_timeout: Через сколько секунд неизменный файл без маркера конца всё же передаётся на распознавание.
+        :param max_unflushed: Максимальное количество записей, ещё не попавших в журнал. Если один бюллетень
+                              обрабатывается долго, следующие за ним ждут в буфере; при достижении предела новые файлы
+                              не выдаются, пока он не завершится (память и потери при аварии ограничены этим числом).
+        :param use_inotify: Если False, используется только сканирование директорий.
+        :param extensions: Расширения файлов изображений.
+        """
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.handler = handler
+        self.options = options or {}
+        self.workers = workers
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.incomplete_timeout = incomplete_timeout
+        self.max_unflushed = max_unflushed
+        self.use_inotify = use_inotify
+        self.extensions = extensions
+
+        self.log = OrderedResultsLog(results_log)
+        # Уже обработанные файлы (путь -> (размер, время изменения)) и хеши содержимого (хеш -> номер записи)
+        self.handled = {record["path"]: (record["size"], record["mtime_ns"]) for record in self.log.records}
+        self.hashes = {record["sha256"]: record["seq"] for record in self.log.records if _is_final(record)}
+        self.candidates = OrderedDict()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self.stop_event = threading.Event()
+        # Канал, через который завершившийся обработчик будит основной цикл, чтобы сразу выдать следующий файл
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+
+    def _observe(self, path, closed, now):
+        """Учитывает событие или результат сканирования для файла path."""
+        if not is_image_file(path, self.extensions):
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.candidates.pop(path, None)
+            return
+        if self.handled.get(path) == (stat.st_size, stat.st_mtime_ns):
+            return
+        candidate = self.candidates.get(path)
+        if candidate is None:
+            candidate = self.candidates[path] = _Candidate(stat, now)
+        candidate.closed = candidate.closed or closed
+
+    def _scan(self, now):
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            self._observe(entry.path, False, now)
+            except FileNotFoundError:
+                continue
+
+    def _is_ready(self, path, candidate, now):
+        """Проверяет, что файл дописан: размер не меняется, а у JPEG/PNG есть маркер конца."""
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) != (candidate.size, candidate.mtime_ns):
+            candidate.size, candidate.mtime_ns = stat.st_size, stat.st_mtime_ns
+            candidate.stable_since = now
+            candidate.closed = False
+            return False
+        stable = now - candidate.stable_since
+        if not candidate.closed and stable < self.settle_seconds:
+            return False
+        return stat.st_size > 0 and (has_end_marker(path) or stable >= self.incomplete_timeout)
+
+    def _dispatch(self, executor, now):
+        """
+        Передаёт готовые файлы на распознавание в порядке поступления, пока есть свободные обработчики
+        и буфер журнала не заполнен.
+        """
+        for path, candidate in list(self.candidates.items()):
+            with self._lock:
+                if self.in_flight >= self.workers:
+                    return
+            if self.log.unflushed() >= self.max_unflushed:
+                return
+            try:
+                ready = self._is_ready(path, candidate, now)
+            except FileNotFoundError:
+                del self.candidates[path]
+                continue
+            if not ready:
+                continue
+            del self.candidates[path]
+            self.handled[path] = (candidate.size, candidate.mtime_ns)
+            seq = self.log.reserve()
+            with self._lock:
+                self.in_flight += 1
+            executor.submit(self._process, seq, path, candidate.size, candidate.mtime_ns,
+                            candidate.arrived_at)
+
+    def _forget_hash(self, record, seq):
+        """Убирает хеш неудачной попытки, чтобы повторно подброшенный снимок распознавался заново."""
+        with self._lock:
+            if record.get("sha256") and self.hashes.get(record["sha256"]) == seq:
+                del self.hashes[record["sha256"]]
+
+    def _process(self, seq, path, size, mtime_ns, arrived_at):
+        record = {"path": path, "size": size, "mtime_ns": mtime_ns, "arrived_at": arrived_at}
+        try:
+            record["sha256"] = make_job_id(path)
+            with self._lock:
+                first = self.hashes.setdefault(record["sha256"], seq)
+            if first != seq:
+                record["duplicate_of"] = first
+            else:
+                record["result"] = self.handler({"image_path": path, "options": self.options})
+                if not _is_final(record):
+                    self._forget_hash(record, seq)
+        except Exception as e:
+            print(f"{path} failed: {e!r}")
+            record["error"] = repr(e)
+            self._forget_hash(record, seq)
+        record["latency_s"] = round(time.time() - arrived_at, 3)
+        self.log.complete(seq, record)
+        with self._lock:
+            self.in_flight -= 1
+        os.write(self._wake_write, b"\0")
+
+    def run(self, exit_when_idle=False):
+        """
+        Основной цикл демона. Останавливается по self.stop_event или, если exit_when_idle, когда не осталось файлов.
+        """
+        watcher = open_watcher(self.directories, self.use_inotify)
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        next_scan = 0.0
+        try:
+            while not self.stop_event.is_set():
+                # Пока есть дописываемые файлы, проверяем их чаще
+                timeout = min(self.poll_interval, self.settle_seconds / 4) if self.candidates else self.poll_interval
+                for path, closed in watcher.poll(timeout, self._wake_read):
+                    self._observe(path, closed, time.time())
+                try:
+                    os.read(self._wake_read, 1 << 12)
+                except BlockingIOError:
+                    pass
+
+                now = time.time()
+                if now >= next_scan or watcher.overflowed:
+                    watcher.overflowed = False
+                    self._scan(now)
+                    next_scan = now + (self.poll_interval if watcher.needs_polling else self.rescan_interval)
+
+                self._dispatch(executor, now)
+
+                if exit_when_idle and not self.candidates:
+                    with self._lock:
+                        if self.in_flight == 0:
+                            break
+        finally:
+            executor.shutdown(wait=True)
+            watcher.close()
+            self.log.close()
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch scanner drop directories and recognize new ballot images")
+    parser.add_argument("directories", nargs="+")
+    parser.add_argument("--results", default="results.jsonl", help="ordered JSONL results log")
+    parser.add_argument("--workers", type=int, default=4, help="maximum number of ballots recognized at once")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds a file must stay unchanged")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--rescan", type=float, default=60.0, help="full rescan period when using inotify")
+    parser.add_argument("--max-unflushed", type=int, default=256,
+                        help="stop taking new files while this many results are not yet written to the log")
+    parser.add_argument("--poll", action="store_true", help="do not use inotify (e.g. for network shares)")
+    parser.add_argument("--budget", type=float, help="per-ballot latency budget in seconds")
+    parser.add_argument("--exit-when-idle", action="store_true")
+    args = parser.parse_args()
+
+    options = {"budget_seconds": args.budget} if args.budget is not None else {}
+    daemon = IngestDaemon(args.directories, args.results, options=options, workers=args.workers,
+                          settle_seconds=args.settle, poll_interval=args.poll_interval, rescan_interval=args.rescan,
+                          max_unflushed=args.max_unflushed, use_inotify=not args.poll)
+    # Завершаем текущие распознавания и выходим по Ctrl+C или SIGTERM
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: daemon.stop_event.set())
+    daemon.run(exit_when_idle=args.exit_when_idle)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+"""
+Этот скрипт реализует общую очередь заданий для распределённого распознавания бюллетеней на нескольких узлах.
+Узлы-обработчики забирают задания из очереди, продлевают аренду (lease) «сердцебиениями» и записывают результат.
+
+Гарантии очереди:
+
+- Аренда с ограниченным сроком: задание, взятое обработчиком, недоступно другим, пока аренда продлевается.
+- Перехват работы (work-stealing): если обработчик упал или завис и перестал продлевать аренду,
+  после истечения её срока задание забирает любой свободный обработчик.
+- Доставка «хотя бы один раз»: задание может быть выполнено повторно, поэтому запись результата идемпотентна —
+  сохраняется первый записанный результат, повторные записи игнорируются.
+
+Поддерживаются два варианта хранения с одинаковым интерфейсом:
+
+- `SQLiteWorkQueue`: общий файл SQLite. Удобен для нескольких процессов на одной машине.
+  SQLite не рекомендуется размещать на сетевых файловых системах (NFS/SMB) из-за ненадёжных блокировок.
+- `DirectoryWorkQueue`: директория на общей файловой системе. Состояние задания определяется тем,
+  в какой поддиректории лежит его файл, а переходы выполняются атомарным переименованием.
+
+Функция `open_queue` выбирает вариант по пути: файлы *.sqlite / *.db открываются как SQLite, остальное — как директория.
+"""
+
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from json_utils import json_default
+
+# Задание, выданное обработчику: идентификатор, полезная нагрузка (словарь) и номер попытки
+Job = namedtuple("Job", ["job_id", "payload", "attempt"])
+
+# Идентификаторы заданий и обработчиков используются в именах файлов, поэтому допускаем только безопасные символы
+SAFE_ID = re.compile(r"^[A-Za-z0-9_.\-]+$")
+
+
+def _check_id(value, what):
+    if not SAFE_ID.match(value):
+        raise ValueError(f"Invalid {what} '{value}': only letters, digits, '_', '.' and '-' are allowed")
+
+
+class SQLiteWorkQueue:
+    """
+    Очередь заданий в общем файле SQLite.
+    Каждый поток получает своё соединение, изменения выполняются в транзакциях BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created REAL NOT NULL
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    job_id TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    worker TEXT NOT NULL,
+                    finished REAL NOT NULL
+                )""")
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    class _Transaction:
+        def __init__(self, db):
+            self.db = db
+
+        def __enter__(self):
+            self.db.execute("BEGIN IMMEDIATE")
+            return self.db
+
+        def __exit__(self, exc_type, exc, tb):
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+            return False
+
+    def _transaction(self):
+        return self._Transaction(self._connection())
+
+    def enqueue(self, job_id, payload):
+        """
+        Добавляет задание. Повторное добавление задания с тем же идентификатором ничего не меняет.
+
+        :return: True, если задание добавлено впервые.
+        """
+        _check_id(job_id, "job id")
+        with self._transaction() as db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO jobs (job_id, payload, created) VALUES (?, ?, ?)",
+                (job_id, json.dumps(payload, ensure_ascii=False), time.time()))
+            return cursor.rowcount == 1
+
+    def lease(self, worker_id, lease_seconds=60):
+        """
+        Выдаёт обработчику следующее задание: ожидающее или с истёкшей арендой (перехват работы).
+
+        :return: Job или None, если заданий нет.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            while True:
+                row = db.execute(
+                    "SELECT job_id, payload, attempts FROM jobs "
+                    "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                    "ORDER BY created LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None
+                job_id, payload, attempts = row
+                if attempts >= self.max_attempts:
+                    # Задание уже несколько раз «роняло» обработчиков — больше не выдаём его
+                    db.execute("UPDATE jobs SET state = 'failed', worker = NULL, "
+                               "error = COALESCE(error, 'lease expired too many times') WHERE job_id = ?", (job_id,))
+                    continue
+                db.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                           "WHERE job_id = ?", (worker_id, now + lease_seconds, job_id))
+                return Job(job_id, json.loads(payload), attempts + 1)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds=60):
+        """
+        Продлевает аренду задания.
+
+        :return: False, если аренда уже потеряна (задание перехвачено другим обработчиком или завершено).
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker = ? AND state = 'leased'",
+                                (time.time() + lease_seconds, job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        """
+        Записывает результат задания. Запись идемпотентна: сохраняется только первый результат.
+
+        :return: True, если этот результат записан первым.
+        """
+        with self._transaction() as db:
+            cursor = db.execute("INSERT OR IGNORE INTO results (job_id, result, worker, finished) VALUES (?, ?, ?, ?)",
+                                (job_id, json.dumps(result, ensure_ascii=False, default=json_default),
+                                 worker_id, time.time()))
+            db.execute("UPDATE jobs SET state = 'done', worker = NULL, lease_expires = NULL WHERE job_id = ?", (job_id,))
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error):
+        """
+        Возвращает задание в очередь после ошибки или помечает его неудавшимся, если попытки исчерпаны.
+        """
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                       "worker = NULL, lease_expires = NULL, error = ? "
+                       "WHERE job_id = ? AND worker = ? AND state = 'leased'",
+                       (self.max_attempts, str(error), job_id, worker_id))
+
+    def results(self):
+        """Возвращает словарь {job_id: результат} по всем завершённым заданиям."""
+        rows = self._connection().execute("SELECT job_id, result FROM results").fetchall()
+        return {job_id: json.loads(result) for job_id, result in rows}
+
+    def stats(self):
+        """Возвращает количество заданий в каждом состоянии."""
+        rows = self._connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+
+class DirectoryWorkQueue:
+    """
+    Очередь заданий в директории на общей файловой системе.
+
+    Структура директории:
+    - pending/<job_id>~<attempts>: ожидающие задания;
+    - leased/<job_id>~<attempts>~<worker>: арендованные задания, время изменения файла — момент истечения аренды;
+    - results/<job_id>.json: результаты (файл результата одновременно означает завершение задания);
+    - failed/<job_id>~<attempts>: задания, исчерпавшие попытки;
+    - tmp/: временные файлы для атомарной записи.
+
+    Все переходы между состояниями выполняются os.rename, которое атомарно в пределах одной файловой системы,
+    поэтому одно задание может арендовать только один обработчик.
+    """
+
+    STATES = ("pending", "leased", "results", "failed", "tmp")
+
+    def __init__(self, root, max_attempts=3):
+        self.root = root
+        self.max_attempts = max_attempts
+        for state in self.STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+    def _write_atomic(self, target, data, overwrite=True):
+        """Пишет файл через временный файл. Без overwrite существующий файл не заменяется (через os.link)."""
+        tmp = self._path("tmp", uuid.uuid4().hex)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            if overwrite:
+                os.replace(tmp, target)
+                return True
+            try:
+                os.link(tmp, target)
+                return True
+            except FileExistsError:
+                return False
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _find(self, state, job_id):
+        prefix = f"{job_id}~"
+        return [name for name in os.listdir(os.path.join(self.root, state)) if name.startswith(prefix)]
+
+    def enqueue(self, job_id, payload):
+        """
+        Добавляет задание. Повторное добавление задания с тем же идентификатором ничего не меняет.
+
+        :return: True, если задание добавлено впервые.
+        """
+        _check_id(job_id, "job id")
+        if os.path.exists(self._path("results", f"{job_id}.json")):
+            return False
+        if any(self._find(state, job_id) for state in ("pending", "leased", "failed")):
+            return False
+        return self._write_atomic(self._path("pending", f"{job_id}~0"),
+                                  json.dumps(payload, ensure_ascii=False), overwrite=False)
+
+    @staticmethod
+    def _entries_by_mtime(directory):
+        """Возвращает пары (mtime, entry), пропуская файлы, которые успел забрать другой обработчик."""
+        entries = []
+        for entry in os.scandir(directory):
+            try:
+                entries.append((entry.stat().st_mtime, entry))
+            except FileNotFoundError:
+                continue
+        entries.sort(key=lambda item: item[0])
+        return entries
+
+    @staticmethod
+    def _set_expiry(path, lease_seconds):
+        # Срок аренды хранится во времени изменения файла, поэтому его видят все узлы
+        expires = time.time() + lease_seconds
+        os.utime(path, (expires, expires))
+
+    def _take(self, source, job_id, attempts, worker_id, lease_seconds):
+        """Атомарно переводит файл задания в leased. Возвращает Job или None, если задание забрал другой обработчик."""
+        target = self._path("leased", f"{job_id}~{attempts + 1}~{worker_id}")
+        try:
+            # Срок аренды выставляется до переименования: rename сохраняет mtime, и иначе файл в leased
+            # успел бы выглядеть просроченным, а другой обработчик перехватил бы его
+            self._set_expiry(source, lease_seconds)
+            os.rename(source, target)
+            with open(target, encoding="utf-8") as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            # Задание забрал другой обработчик
+            return None
+        return Job(job_id, payload, attempts + 1)
+
+    def lease(self, worker_id, lease_seconds=60):
+        """
+        Выдаёт обработчику следующее задание: ожидающее или с истёкшей арендой (перехват работы).
+
+        :return: Job или None, если заданий нет.
+        """
+        _check_id(worker_id, "worker id")
+
+        for _, entry in self._entries_by_mtime(os.path.join(self.root, "pending")):
+            job_id, attempts = entry.name.split("~")
+            if os.path.exists(self._path("results", f"{job_id}.json")):
+                # Результат уже есть (задание было добавлено повторно) — просто убираем его
+                self._remove(entry.path)
+                continue
+            job = self._take(entry.path, job_id, int(attempts), worker_id, lease_seconds)
+            if job is not None:
+                return job
+
+        # Перехват работы у обработчиков, переставших продлевать аренду
+        now = time.time()
+        for expires, entry in self._entries_by_mtime(os.path.join(self.root, "leased")):
+            if expires >= now:
+                break
+            job_id, attempts, _ = entry.name.split("~")
+            if int(attempts) >= self.max_attempts:
+                try:
+                    os.rename(entry.path, self._path("failed", f"{job_id}~{attempts}"))
+                except FileNotFoundError:
+                    pass
+                continue
+            job = self._take(entry.path, job_id, int(attempts), worker_id, lease_seconds)
+            if job is not None:
+                return job
+        return None
+
+    def _leased_path(self, job_id, worker_id):
+        for name in self._find("leased", job_id):
+            if name.endswith(f"~{worker_id}"):
+                return self._path("leased", name)
+        return None
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def heartbeat(self, job_id, worker_id, lease_seconds=60):
+        """
+        Продлевает аренду задания.
+
+        :return: False, если аренда уже потеряна (задание перехвачено другим обработчиком или завершено).
+        """
+        path = self._leased_path(job_id, worker_id)
+        if path is None:
+            return False
+        try:
+            self._set_expiry(path, lease_seconds)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, job_id, worker_id, result):
+        """
+        Записывает результат задания. Запись идемпотентна: сохраняется только первый результат.
+
+        :return: True, если этот результат записан первым.
+        """
+        data = json.dumps({"job_id": job_id, "worker": worker_id, "finished": time.time(), "result": result},
+                          ensure_ascii=False, default=json_default)
+        written = self._write_atomic(self._path("results", f"{job_id}.json"), data, overwrite=False)
+        path = self._leased_path(job_id, worker_id)
+        if path is not None:
+            self._remove(path)
+        return written
+
+    def fail(self, job_id, worker_id, error):
+        """
+        Возвращает задание в очередь после ошибки или помечает его неудавшимся, если попытки исчерпаны.
+        """
+        path = self._leased_path(job_id, worker_id)
+        if path is None:
+            return
+        attempts = int(os.path.basename(path).split("~")[1])
+        state = "failed" if attempts >= self.max_attempts else "pending"
+        try:
+            os.rename(path, self._path(state, f"{job_id}~{attempts}"))
+        except FileNotFoundError:
+            return
+        if state == "failed":
+            self._write_atomic(self._path("failed", f"{job_id}.error"), str(error))
+
+    def results(self):
+        """Возвращает словарь {job_id: результат} по всем завершённым заданиям."""
+        results = {}
+        for entry in os.scandir(os.path.join(self.root, "results")):
+            with open(entry.path, encoding="utf-8") as f:
+                record = json.load(f)
+            results[record["job_id"]] = record["result"]
+        return results
+
+    def stats(self):
+        """Возвращает количество заданий в каждом состоянии."""
+        return {
+            "pending": len(os.listdir(os.path.join(self.root, "pending"))),
+            "leased": len(os.listdir(os.path.join(self.root, "leased"))),
+            "done": len(os.listdir(os.path.join(self.root, "results"))),
+            "failed": len([name for name in os.listdir(os.path.join(self.root, "failed")) if "~" in name]),
+        }
+
+
+def open_queue(location, max_attempts=3):
+    """
+    Открывает очередь по пути: файл *.sqlite / *.db — SQLite, иначе — директория на общей файловой системе.
+
+    :param location: Путь к файлу SQLite или к директории очереди.
+    :param max_attempts: Сколько раз задание может быть выдано, прежде чем оно будет помечено неудавшимся.
+    """
+    if location.endswith((".sqlite", ".sqlite3", ".db")):
+        return SQLiteWorkQueue(location, max_attempts)
+    return DirectoryWorkQueue(location, max_attempts)